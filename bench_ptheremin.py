@@ -0,0 +1,285 @@
+#!/bin/env python
+
+"""Benchmarks for PTheremin's hot paths.
+
+Runs the synthesis engine, the note quantizer, the recorder and the WAV
+exporter without GTK or a sound card, and saves the numbers as JSON so runs
+from different commits can be compared.
+"""
+
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy
+
+import ptheremin
+
+
+def timed(func, min_time=0.5):
+    """Calls func until at least min_time seconds have gone by, returns the calls and seconds taken."""
+    calls = 0
+    start = time.time()
+    while 1:
+        func()
+        calls += 1
+        elapsed = time.time() - start
+        if elapsed >= min_time:
+            return calls, elapsed
+
+
+def bench_synthesis(fs=44100, block_size=ptheremin.BLOCK_SIZE):
+    """Samples rendered per second for every oscillator, waveform and interpolation."""
+    results = {}
+    for oscillator in ptheremin.OSCILLATORS:
+        for waveform in ptheremin.WAVEFORMS:
+            for interpolation in ptheremin.INTERPOLATIONS:
+                if waveform == 'sine' and interpolation != 'linear':
+                    continue # sine doesn't use the tables
+
+                engine = ptheremin.ToneEngine(fs, block_size, oscillator, waveform, interpolation)
+                encode = ptheremin.AudioFormat(fs).encode
+                freqs = iter(numpy.linspace(100, 1000, 1000000))
+
+                def render():
+                    engine.set_new_freq(freqs.next(), 0.8)
+                    encode(engine.render())
+
+                calls, elapsed = timed(render)
+                results["%s/%s/%s" % (oscillator, waveform, interpolation)] = calls*block_size/elapsed
+
+    return results
+
+
+def bench_oversampling(fs=44100, block_size=ptheremin.BLOCK_SIZE):
+    """Microseconds per block at each oversampling factor, for a saw high enough to need the lot."""
+    results = {}
+    for oversample in ptheremin.OVERSAMPLING:
+        for interpolation in ptheremin.INTERPOLATIONS:
+            engine = ptheremin.ToneEngine(fs, block_size, 'phase', 'saw', interpolation, oversample=oversample)
+            engine.set_new_freq(3520, 0.8)
+
+            calls, elapsed = timed(engine.render)
+            results["%dx/%s" % (oversample, interpolation)] = elapsed/calls*1e6
+
+    return results
+
+
+def bench_voices(fs=44100, block_size=ptheremin.BLOCK_SIZE):
+    """Microseconds per block for more and more voices, with the phase oscillator and a wavetable."""
+    results = {}
+    for count in (1, 2, 4, 8, ptheremin.MAX_VOICES):
+        engine = ptheremin.ToneEngine(fs, block_size, 'phase', 'saw')
+        engine.set_new_freq(220, 0.5, [(220*(i + 2), 0.5/(i + 2)) for i in range(count - 1)])
+
+        calls, elapsed = timed(engine.render)
+        results[str(count)] = elapsed/calls*1e6
+
+    return results
+
+
+def bench_filters(fs=44100, block_size=ptheremin.BLOCK_SIZE):
+    """Microseconds to filter a block, for a few chains."""
+    chains = {
+        'lowpass': [('lowpass', 1200.0)],
+        'bandpass': [('bandpass', 800.0, 2.0)],
+        'formant': [('formant', 'a')],
+        'formant+lowpass+highpass': [('formant', 'a'), ('lowpass', 3000.0), ('highpass', 80.0)],
+    }
+
+    results = {}
+    block = numpy.random.uniform(-0.5, 0.5, block_size)
+    for name, filters in chains.items():
+        chain = ptheremin.FilterChain(filters, fs, block_size)
+        calls, elapsed = timed(lambda: chain.process(block))
+        results[name] = elapsed/calls*1e6
+
+    return results
+
+
+def bench_resampler(block_size=ptheremin.BLOCK_SIZE):
+    """Milliseconds of CPU to resample a second of audio, between a few common rates."""
+    results = {}
+    block = numpy.random.uniform(-0.5, 0.5, block_size)
+    for rate_in, rate_out in ((44100, 48000), (48000, 44100), (22050, 48000)):
+        resampler = ptheremin.Resampler(rate_in, rate_out)
+        calls, elapsed = timed(lambda: resampler.process(block))
+        results["%d-%d" % (rate_in, rate_out)] = elapsed/(calls*block_size/float(rate_in))*1000
+
+    return results
+
+
+def bench_quantizer():
+    """Nanoseconds per nearest-note lookup for each scale."""
+    results = {}
+    xs = [float(x) for x in numpy.random.uniform(20, 2000, 10000)]
+    for scale in ptheremin.SCALES:
+        index = ptheremin.note_table(scale, 'C').index
+
+        def lookup():
+            for x in xs:
+                index(x)
+
+        calls, elapsed = timed(lookup)
+        results[scale] = elapsed/(calls*len(xs))*1e9
+
+    return results
+
+
+def fill_recording(recording, frames, block_size=ptheremin.BLOCK_SIZE):
+    block = (numpy.random.uniform(-1, 1, block_size)*10000).astype(recording.dtype)
+    for i in range(frames/block_size):
+        recording.append(block)
+
+
+def bench_recording(fs=44100):
+    """Memory taken by a minute of recording, in megabytes."""
+    # ru_maxrss only goes up, so take the pages in use after a minute's
+    # worth of appends straight from /proc where it's available
+    def rss():
+        try:
+            statm = open('/proc/self/statm').read().split()
+            return int(statm[1])*resource.getpagesize()
+        except IOError:
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+
+    before = rss()
+    recording = ptheremin.Recording()
+    start = time.time()
+    fill_recording(recording, 60*fs)
+    elapsed = time.time() - start
+    used = rss() - before
+    recording.close()
+
+    return {
+        'mb_per_minute': used/1e6,
+        'append_ns_per_sample': elapsed/(60*fs)*1e9,
+    }
+
+
+def bench_export(fs=44100, minutes=5):
+    """WAV export speed, in megabytes a second."""
+    recording = ptheremin.Recording(max_frames=60*fs)
+    fill_recording(recording, minutes*60*fs)
+
+    fd, filename = tempfile.mkstemp(suffix='.wav', prefix='ptheremin-bench-')
+    os.close(fd)
+    try:
+        start = time.time()
+        export = ptheremin.ExportThread(recording, filename, ptheremin.AudioFormat(fs))
+        export.run()
+        elapsed = time.time() - start
+        size = os.path.getsize(filename)
+    finally:
+        recording.close()
+        os.remove(filename)
+
+    return {
+        'mb_per_second': size/1e6/elapsed,
+        'seconds': elapsed,
+    }
+
+
+def git_commit():
+    try:
+        here = os.path.dirname(os.path.abspath(__file__))
+        return subprocess.Popen(['git', 'rev-parse', 'HEAD'], cwd=here,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()[0].strip()
+    except OSError:
+        return None
+
+
+BENCHMARKS = (
+    ('synthesis_samples_per_second', bench_synthesis),
+    ('oversampling_us_per_block', bench_oversampling),
+    ('voices_us_per_block', bench_voices),
+    ('filters_us_per_block', bench_filters),
+    ('resampler_ms_per_second', bench_resampler),
+    ('quantizer_ns_per_lookup', bench_quantizer),
+    ('recording', bench_recording),
+    ('export', bench_export),
+)
+
+
+def run(names=None):
+    results = {
+        'commit': git_commit(),
+        'time': time.time(),
+        'python': platform.python_version(),
+        'numpy': numpy.__version__,
+        'machine': platform.machine(),
+    }
+
+    for name, bench in BENCHMARKS:
+        if names and name.split('_')[0] not in names:
+            continue
+        sys.stderr.write("running %s...\n" % name)
+        results[name] = bench()
+
+    return results
+
+
+def flatten(results, prefix=''):
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + '.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[prefix + key] = value
+    return flat
+
+
+def report(results, baseline=None):
+    flat = flatten(dict((k, v) for k, v in results.items() if k != 'time'))
+    old = baseline and flatten(baseline) or {}
+
+    width = max([len(k) for k in flat])
+    for key in sorted(flat):
+        line = "%-*s %14.2f" % (width, key, flat[key])
+        if old.get(key):
+            line += "   %+6.1f%%" % ((flat[key]/old[key] - 1)*100)
+        print line
+
+
+def usage(pname):
+    print """Usage:  %s [OPTIONS] [BENCHMARK...]
+
+Benchmarks: synthesis, oversampling, voices, filters, resampler, quantizer, recording, export (all of them by default)
+
+Options:
+
+    --output=FILE   Save the results as JSON.
+    --compare=FILE  Show the change from results saved by an earlier run.
+    --help          Display this help text and exit.
+    """ % pname
+
+
+def main():
+    import getopt
+
+    opts, args = getopt.getopt(sys.argv[1:], '', ['output=', 'compare=', 'help'])
+
+    output = None
+    baseline = None
+    for opt,val in opts:
+        if opt == '--output':
+            output = val
+        elif opt == '--compare':
+            baseline = json.load(open(val))
+        elif opt == '--help':
+            usage(sys.argv[0])
+            sys.exit(0)
+
+    results = run(args)
+    report(results, baseline)
+
+    if output:
+        json.dump(results, open(output, 'w'), indent=2, sort_keys=True)
+
+
+if __name__ == '__main__': main()
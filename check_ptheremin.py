@@ -0,0 +1,236 @@
+#!/bin/env python
+
+"""Checks PTheremin's fast paths against slow, obviously right versions of them.
+
+Each check runs without GTK or a sound card and prints the largest
+difference it found.  The exit status is 1 if any of them is off by more
+than it should be.
+"""
+
+import multiprocessing
+import sys
+import time
+
+import numpy
+
+import ptheremin
+
+
+def linear_scan(tones):
+    """The discrete mode's original note filter, which ToneIndex replaced."""
+    def filt(x):
+        closest = tones[0]
+        err = 500000
+        mean = 0
+
+        for i,tone in enumerate(tones):
+            tone_err = abs(x - tone)
+            if tone_err < err:
+                closest = tone
+                err = tone_err
+            elif tone_err > err:
+                if i > 0:
+                    mean = (x - closest)/2
+                break
+
+        return closest + mean
+
+    return filt
+
+
+def check_quantizer(count=20000):
+    """ToneIndex against the linear scan over the sorted notes, for every scale and key."""
+    error = 0.0
+    for scale in ptheremin.SCALES:
+        for key in ptheremin.KEYS:
+            table = ptheremin.note_table(scale, key)
+            index = table.index
+            scan = linear_scan(sorted(table.freqs))
+
+            xs = numpy.random.uniform(1, 2*max(table.freqs), count/len(ptheremin.KEYS))
+            error = max(error, max([abs(index(x) - scan(x)) for x in xs]))
+    return error, 0.0
+
+
+def rbj(kind, freq, fs, q=0.7071):
+    """The (b, a) coefficients of an RBJ cookbook biquad, worked out again from scratch."""
+    w = 2*numpy.pi*freq/fs
+    alpha = numpy.sin(w)/(2*q)
+    cos = numpy.cos(w)
+    b = {
+        'lowpass': [(1 - cos)/2, 1 - cos, (1 - cos)/2],
+        'highpass': [(1 + cos)/2, -(1 + cos), (1 + cos)/2],
+        'bandpass': [alpha, 0, -alpha],
+    }[kind]
+    a = [1 + alpha, -2*cos, 1 - alpha]
+    return [x/a[0] for x in b], [x/a[0] for x in a]
+
+
+def difference_equation(b, a, x):
+    """Filters x one sample at a time, straight from the definition."""
+    y = numpy.zeros(len(x))
+    for n in range(len(x)):
+        y[n] = b[0]*x[n]
+        if n >= 1:
+            y[n] += b[1]*x[n - 1] - a[1]*y[n - 1]
+        if n >= 2:
+            y[n] += b[2]*x[n - 2] - a[2]*y[n - 2]
+    return y
+
+
+def reference_filter(filters, fs, x):
+    for f in filters:
+        if f[0] == 'formant':
+            formants = ptheremin.VOWELS[f[1]]
+            total = sum([gain for freq, gain in formants])
+            y = numpy.zeros(len(x))
+            for freq, gain in formants:
+                b, a = rbj('bandpass', freq, fs, 8.0)
+                y += gain/total*difference_equation(b, a, x)
+            x = y
+        else:
+            b, a = rbj(f[0], f[1], fs, *f[2:])
+            x = difference_equation(b, a, x)
+    return x
+
+
+def check_filters(fs=44100, seconds=0.5):
+    """FilterChain against running each filter a sample at a time, fed in blocks of odd sizes."""
+    chains = (
+        [('lowpass', 1200.0)],
+        [('highpass', 300.0, 2.0)],
+        [('bandpass', 800.0, 4.0)],
+        [('formant', 'o')],
+        [('formant', 'a'), ('lowpass', 3000.0), ('highpass', 80.0)],
+    )
+
+    # quiet enough that the chain's clipping never comes into it
+    x = numpy.random.uniform(-0.1, 0.1, int(fs*seconds))
+    error = 0.0
+    for filters in chains:
+        chain = ptheremin.FilterChain(filters, fs)
+        out = []
+        start = 0
+        for size in [ptheremin.BLOCK_SIZE, 1, 7, 300, ptheremin.FILTER_BLOCK*2 + 5]*1000:
+            if start >= len(x):
+                break
+            out.append(chain.process(x[start:start + size]))
+            start += size
+
+        error = max(error, abs(numpy.concatenate(out) - reference_filter(filters, fs, x)).max())
+    return error, 1e-12
+
+
+def feedback_line(x, delay, g):
+    """Returns v with v[n] = x[n] + g*v[n - delay], and v delayed, a sample at a time."""
+    v = numpy.zeros(len(x))
+    delayed = numpy.zeros(len(x))
+    for n in range(len(x)):
+        if n >= delay:
+            delayed[n] = v[n - delay]
+        v[n] = x[n] + g*delayed[n]
+    return v, delayed
+
+
+def reference_delay(x, fs):
+    delay = ptheremin.Delay
+    v, delayed = feedback_line(x, int(delay.seconds*fs), delay.feedback)
+    return x + delay.mix*delayed
+
+
+def reference_reverb(x, fs):
+    reverb = ptheremin.Reverb
+    scale = fs/44100.0
+    mixed = numpy.zeros(len(x))
+    for d in reverb.combs:
+        v, delayed = feedback_line(x, int(d*scale), reverb.comb_feedback)
+        mixed += v/len(reverb.combs)
+
+    for d in reverb.allpasses:
+        v, delayed = feedback_line(mixed, int(d*scale), reverb.allpass_feedback)
+        mixed = delayed - reverb.allpass_feedback*v
+
+    return x + reverb.wet*mixed
+
+
+def check_effects(fs=44100, seconds=1.0):
+    """The delay and reverb against running their feedback loops a sample at a time."""
+    x = numpy.random.uniform(-0.3, 0.3, int(fs*seconds))
+    error = 0.0
+    for effect, reference in ((ptheremin.Delay, reference_delay), (ptheremin.Reverb, reference_reverb)):
+        effect = effect(fs)
+        out = []
+        start = 0
+        for size in [ptheremin.BLOCK_SIZE, 1, 7, 100]*10000:
+            if start >= len(x):
+                break
+            out.append(effect.process(x[start:start + size].copy()))
+            start += size
+
+        error = max(error, abs(numpy.concatenate(out) - reference(x, fs)).max())
+    return error, 1e-12
+
+
+def _publish_forever(mailbox):
+    i = 0
+    while 1:
+        i += 1
+        mailbox.publish(freq=float(i), vol=float(i), waveform=ptheremin.WAVEFORMS[i % 2 + 1])
+
+
+def check_mailbox(seconds=1.0):
+    """Reads a SharedParamMailbox while another process writes to it, counting reads that mix two writes."""
+    mailbox = ptheremin.SharedParamMailbox(freq=1.0, vol=1.0, waveform=ptheremin.WAVEFORMS[2])
+    writer = multiprocessing.Process(target=_publish_forever, args=(mailbox,))
+    writer.daemon = True
+    writer.start()
+
+    torn = 0
+    end = time.time() + seconds
+    try:
+        while time.time() < end:
+            params = mailbox.snapshot
+            if (params.freq != params.vol or params.freq < 1 or
+                params.waveform != ptheremin.WAVEFORMS[int(params.freq) % 2 + 1]):
+                torn += 1
+    finally:
+        writer.terminate()
+        writer.join()
+    return torn, 0
+
+
+CHECKS = (
+    ('quantizer', check_quantizer),
+    ('filters', check_filters),
+    ('effects', check_effects),
+    ('mailbox', check_mailbox),
+)
+
+
+def usage(pname):
+    print """Usage:  %s [CHECK...]
+
+Checks: %s (all of them by default)
+    """ % (pname, ", ".join([name for name, check in CHECKS]))
+
+
+def main():
+    names = sys.argv[1:]
+    if '--help' in names:
+        usage(sys.argv[0])
+        sys.exit(0)
+
+    failed = False
+    for name, check in CHECKS:
+        if names and name not in names:
+            continue
+
+        error, allowed = check()
+        ok = error <= allowed
+        failed = failed or not ok
+        print "%-12s max error %.3g  %s" % (name, error, ok and "ok" or "FAILED")
+
+    sys.exit(failed and 1 or 0)
+
+
+if __name__ == '__main__': main()
@@ -6,28 +6,63 @@ A 2-dimension area serves for control of the instrument; the user drags the mous
 
 For better musical sound run your sound card into a guitar amp or similar.
 
-Requires Python 2.3+ and PyGTK 2.4+ (not tested on anything older).
+Requires Python 2.3+, NumPy and PyGTK 2.4+ (not tested on anything older).
 
 http://ptheremin.sourceforge.net
 """
 
-import array
+import bisect
+import collections
+import errno
 import fcntl
+import fractions
 import math
+import mmap
+import multiprocessing
+import os
 import ossaudiodev
+import select
 import struct
+import sys
+import tempfile
 import threading
 import time
 import wave
 
-import pygtk
-pygtk.require('2.0')
-import gtk
-import pango
+import numpy
 
+# the synth, the audio backends and the headless tools work without a display
+try:
+    import pygtk
+    pygtk.require('2.0')
+    import gobject
+    import gtk
+    import pango
+except ImportError:
+    gtk = None
 
+
+OSCILLATORS = ("zero crossing", "phase")
+WAVEFORMS = ("sine", "saw", "square", "triangle", "theremin")
+INTERPOLATIONS = ("linear", "cubic")
 SCALES = ("chromatic", "diatonic major", "pentatonic major", "pentatonic minor", "blues")
+BACKENDS = ("oss", "alsa", "wav", "raw", "null")
+ENGINES = ("thread", "process") # where the audio engine runs
+SAMPLE_FORMATS = ("s16", "s32", "float32") # little-endian
+SCHED_POLICIES = ("other", "fifo", "rr") # in the order of Linux's SCHED_* numbers
+MCL_CURRENT, MCL_FUTURE, MCL_ONFAULT = 1, 2, 4
 INIT_FREQ = 20
+CONTROL_RATE = 200 # times a second the pointer position is passed on to the synth
+STATUS_RATE = 25 # times a second the statusbar can change
+RECORDING_CHUNK = 1 << 16 # frames per chunk of a recording, about 1.5 seconds
+RECORDING_FRAMES = 10*60*44100 # frames of a recording kept in memory
+FREQ_MAX = 2000
+WAVETABLE_SIZE = 2048 # samples per period in a wavetable
+MIPMAP_BASE = 20.0 # the highest frequency the fullest wavetable is for, each one after is an octave up
+OVERSAMPLING = (1, 2, 4)
+BLOCK_SIZE = 256 # frames rendered per device write, trades latency for CPU
+MAX_VOICES = 16 # including the lead
+FILTER_BLOCK = 256 # longest stretch a filter's block matrices cover
 
 NAME="PTheremin"
 VERSION="0.2.1"
@@ -51,88 +86,2037 @@ for octave in range(11):
     for label,freq in equal_temp_tuning:
         NOTES.append((label.replace('*', "%d" % octave), (2**octave)*freq))
 
-def just_freqs(notes):
-    return [freq for label,freq in notes]
+TUNINGS = {'equal': NOTES}
+
+SCALE_INTERVALS = {
+    'chromatic': tuple(range(12)),
+    'diatonic major': diatonic_major_intervals,
+    'pentatonic major': pentatonic_major_intervals,
+    'pentatonic minor': pentatonic_minor_intervals,
+    'blues': blues_intervals,
+}
+
+VOICINGS = ("solo", "octave", "drone", "thirds", "triad", "choir")
+
+# the voices played along with the lead, each (kind, how far, gain): a number
+# of octaves up or down, a number of scale degrees up or down from the
+# nearest note, or a drone on the key's root in the given octave
+VOICING_PARTS = {
+    'solo': (),
+    'octave': (('octave', -1, 0.7),),
+    'drone': (('drone', 2, 0.5),),
+    'thirds': (('degree', 2, 0.7),),
+    'triad': (('degree', 2, 0.6), ('degree', 4, 0.6)),
+    'choir': (('octave', -2, 0.4), ('octave', -1, 0.5), ('degree', 2, 0.5), ('degree', 4, 0.5),
+              ('degree', 9, 0.3), ('degree', 11, 0.3), ('octave', 1, 0.25), ('drone', 1, 0.4)),
+}
+
+FILTERS = ("lowpass", "highpass", "bandpass", "formant")
+
+# (frequency, gain) of the first three formants of each vowel, roughly
+VOWELS = {
+    'a': ((800, 1.0), (1150, 0.5), (2900, 0.25)),
+    'e': ((400, 1.0), (1600, 0.35), (2700, 0.2)),
+    'i': ((350, 1.0), (1700, 0.1), (2700, 0.1)),
+    'o': ((450, 1.0), (800, 0.35), (2830, 0.1)),
+    'u': ((325, 1.0), (700, 0.25), (2530, 0.05)),
+}
+
+EFFECTS = ("vibrato", "tremolo", "delay", "reverb")
+
+KEYS = ("A", "A#", "B", "C", "C#", "D", "D#", "E", "F", "F#", "G", "G#")
+
+# semitones up from C
+KEY_SHIFTS = {
+    'A': 9,
+    'A#': 10,
+    'B': 11,
+    'C': 0,
+    'C#': 1,
+    'D': 2,
+    'D#': 3,
+    'E': 4,
+    'F': 5,
+    'F#': 6,
+    'G': 7,
+    'G#': 8,
+}
+
+# harmonic amplitudes of the "classic" timbre, a sine with a little buzz on top
+theremin_harmonics = (1.0, 0.28, 0.12, 0.05, 0.025, 0.01)
+
+_wavetables = {}
+
+def wavetable(waveform, harmonics, size=WAVETABLE_SIZE):
+    """Returns a cached single period of a waveform made from at most the given number of harmonics.
+
+    The table has one extra point before the period and two after so that
+    interpolation never has to wrap its indices.
+    """
+    key = (waveform, harmonics, size)
+    if key in _wavetables:
+        return _wavetables[key]
+
+    t = numpy.arange(-1, size + 2)/float(size)
+    table = numpy.zeros(len(t))
+    for k in range(1, harmonics + 1):
+        if waveform == 'sine':
+            amp = k == 1 and 1.0 or 0.0
+        elif waveform == 'saw':
+            amp = 2/(math.pi*k)*(-1)**(k + 1)
+        elif waveform == 'square':
+            amp = k % 2 and 4/(math.pi*k) or 0.0
+        elif waveform == 'triangle':
+            amp = k % 2 and 8/(math.pi*k)**2*(-1)**((k - 1)/2) or 0.0
+        elif waveform == 'theremin':
+            amp = k <= len(theremin_harmonics) and theremin_harmonics[k - 1] or 0.0
+        else:
+            raise ValueError("unknown waveform %r" % waveform)
+
+        if amp:
+            table += amp*numpy.sin(2*math.pi*k*t)
+
+    table /= numpy.abs(table).max()
+
+    _wavetables[key] = table
+    return table
+
+
+_mipmaps = {}
+
+def mipmap(waveform, fs, size=WAVETABLE_SIZE):
+    """Returns (cached) wavetables for a waveform with fewer harmonics an octave at a time, one to a row.
+
+    Row j is band-limited for fundamentals up to MIPMAP_BASE*2**j, so none
+    of its harmonics go past fs/2 there; mipmap_level() picks the row.
+    """
+    key = (waveform, fs, size)
+    if key in _mipmaps:
+        return _mipmaps[key]
+
+    tables = []
+    top = MIPMAP_BASE
+    while 1:
+        harmonics = max(1, min(size/2 - 1, int(fs/2.0/top)))
+        tables.append(wavetable(waveform, harmonics, size))
+        if harmonics == 1:
+            break
+        top *= 2
+
+    tables = _mipmaps[key] = numpy.vstack(tables)
+    return tables
+
+
+def mipmap_level(freqs, levels):
+    """Returns the row of a mipmap() for a frequency, or an array of them for an array of frequencies."""
+    octaves = numpy.log2(numpy.maximum(freqs, MIPMAP_BASE)/MIPMAP_BASE)
+    return numpy.minimum(numpy.ceil(octaves), levels - 1).astype(numpy.intp)
+
+
+def wavetable_lookup(table, phases, interpolation='linear', rows=None):
+    """Reads a wavetable at the given phases (from 0 to 1).
+
+    With rows given, the table is a mipmap() and each row of phases is read
+    from the given row of it.
+    """
+    size = table.shape[-1] - 3
+    pos = phases*size
+    i = pos.astype(numpy.intp)
+    frac = pos - i
+    i += 1 # skip the leading guard point
+    if rows is not None:
+        i += (rows*table.shape[1])[:, None]
+        table = table.ravel()
+
+    y0 = table[i]
+    y1 = table[i + 1]
+    if interpolation == 'linear':
+        return y0 + frac*(y1 - y0)
+
+    # 4-point Catmull-Rom spline
+    ym1 = table[i - 1]
+    y2 = table[i + 2]
+    c1 = 0.5*(y1 - ym1)
+    c2 = ym1 - 2.5*y0 + 2*y1 - 0.5*y2
+    c3 = 0.5*(y2 - ym1) + 1.5*(y0 - y1)
+    return ((c3*frac + c2)*frac + c1)*frac + y0
+
+
+# what the controls are asking the synth for, as of the timestamp.  voices
+# are the (freq, vol) of each voice played along with the lead.
+Params = collections.namedtuple('Params', 'freq vol waveform oscillator timestamp voices')
+
+class ParamMailbox(object):
+    """Passes control parameters to the audio thread without locking.
+
+    Each publish() builds a whole new Params and swaps it in with a single
+    attribute assignment, which is atomic, so the audio thread can never see
+    a new frequency with an old volume.  It reads the snapshot once a block.
+    """
+
+    def __init__(self, freq=INIT_FREQ, vol=1, waveform='sine', oscillator='zero crossing'):
+        self.snapshot = Params(freq, vol, waveform, oscillator, time.time(), ())
+
+
+    def publish(self, **changes):
+        """Replaces some of the parameters, e.g. publish(freq=440, vol=0.5)."""
+        changes['timestamp'] = time.time()
+        self.snapshot = self.snapshot._replace(**changes)
+
+
+class SharedParamMailbox(object):
+    """A ParamMailbox kept in shared memory, so an engine in a forked process can read it.
+
+    There's only room for one writer.  It makes the sequence number odd
+    while it writes and even again when it's done, and a reader that sees
+    an odd or changed sequence number just reads again, so neither side
+    ever waits on a lock.
+    """
+
+    # sequence, freq, vol, timestamp, waveform, oscillator, voice count, then
+    # room for the freq and vol of every voice
+    layout = struct.Struct('<QdddBBB%dd' % (2*(MAX_VOICES - 1)))
+    sequence = struct.Struct('<Q')
+
+    def __init__(self, freq=INIT_FREQ, vol=1, waveform='sine', oscillator='zero crossing'):
+        self.mem = mmap.mmap(-1, self.layout.size)
+        self._sequence = 0
+        self._write(Params(freq, vol, waveform, oscillator, time.time(), ()))
+
+
+    def _write(self, params):
+        voices = [x for voice in params.voices for x in voice]
+        voices += [0.0]*(2*(MAX_VOICES - 1) - len(voices))
+
+        # pack_into would zero the whole record, sequence number and all,
+        # before filling it in, so only the payload goes into the mmap
+        data = self.layout.pack(0, params.freq, params.vol, params.timestamp,
+                                WAVEFORMS.index(params.waveform), OSCILLATORS.index(params.oscillator),
+                                len(params.voices), *voices)
+        start = self.sequence.size
+
+        self._sequence += 1
+        self.sequence.pack_into(self.mem, 0, self._sequence)
+        self.mem[start:len(data)] = data[start:]
+        self._sequence += 1
+        self.sequence.pack_into(self.mem, 0, self._sequence)
+
+
+    def _read(self):
+        while 1:
+            fields = self.layout.unpack_from(self.mem, 0)
+            seq, freq, vol, timestamp, waveform, oscillator, count = fields[:7]
+            if not seq % 2 and self.sequence.unpack_from(self.mem, 0)[0] == seq:
+                voices = tuple(zip(fields[7:7 + 2*count:2], fields[8:8 + 2*count:2]))
+                return Params(freq, vol, WAVEFORMS[waveform], OSCILLATORS[oscillator], timestamp, voices)
+
+    snapshot = property(_read)
+
+
+    def publish(self, **changes):
+        """Replaces some of the parameters, e.g. publish(freq=440, vol=0.5)."""
+        changes['timestamp'] = time.time()
+        self._write(self._read()._replace(**changes))
+
+
+class VoicePool(object):
+    """The voices played along with the lead, all rendered together.
+
+    Each voice is a phase accumulator that glides like the "phase"
+    oscillator.  Their state is kept in arrays with a row per voice and the
+    working space is allocated up front, so a block for every voice takes
+    the same handful of numpy calls as a block for one.
+    """
+
+    def __init__(self, fs, block_size=BLOCK_SIZE, size=MAX_VOICES - 1):
+        self.fs = fs
+        self.block_size = block_size
+        self.size = size
+        self.active = 0 # voices sounding, or fading out during the next block
+
+        self.freqs = numpy.zeros(size) # at the end of the last block
+        self.vols = numpy.zeros(size)
+        self.phases = numpy.zeros(size)
+        self.new_freqs = numpy.zeros(size)
+        self.new_vols = numpy.zeros(size)
+
+        self.ramp = numpy.arange(1, block_size + 1)/float(block_size)
+        self.incs = numpy.empty((size, block_size))
+        self.gains = numpy.empty((size, block_size))
+        self.out = numpy.empty((size, block_size))
+
+
+    def render(self, voices, waveform, tables, interpolation='linear'):
+        """Returns the mix of a block of voices, each a (freq, vol), reading waveforms from a mipmap()."""
+        if len(voices) > self.size:
+            raise ValueError("at most %d voices can play along" % self.size)
+
+        new_freqs, new_vols = self.new_freqs, self.new_vols
+        new_freqs[:] = self.freqs # voices that stop fade out at the pitch they had
+        new_vols[:] = 0
+        for i, (freq, vol) in enumerate(voices):
+            new_freqs[i] = freq
+            new_vols[i] = vol
+
+        n = max(len(voices), self.active)
+        freqs, vols, phases = self.freqs[:n], self.vols[:n], self.phases[:n]
+        new_freqs, new_vols = new_freqs[:n], new_vols[:n]
+        ramp = self.ramp
+        incs, gains, out = self.incs[:n], self.gains[:n], self.out[:n]
+
+        # voices coming in start at their pitch rather than sliding up to it
+        silent = vols == 0
+        freqs[silent] = new_freqs[silent]
+
+        # the same ramps as ToneEngine._ramped_phases(), a row per voice
+        numpy.multiply((new_freqs - freqs)[:, None], ramp, incs)
+        incs += freqs[:, None]
+        incs /= float(self.fs)
+        numpy.cumsum(incs, axis=1, out=out)
+        end = phases + out[:, -1]
+        out -= incs
+        out += phases[:, None]
+        out %= 1.0
+
+        numpy.multiply((new_vols - vols)[:, None], ramp, gains)
+        gains += vols[:, None]
+
+        if waveform == 'sine':
+            out *= 2*math.pi
+            numpy.sin(out, out)
+        else:
+            # each voice gets the table for the highest it goes this block
+            rows = mipmap_level(numpy.maximum(freqs, new_freqs), len(tables))
+            out[:] = wavetable_lookup(tables, out, interpolation, rows)
+        out *= gains
+
+        phases[:] = end % 1.0
+        freqs[:] = new_freqs
+        vols[:] = new_vols
+        self.active = len(voices)
+        return out.sum(axis=0)
+
+
+# a linear filter as a state space system: x' = A x + B u, y = C x + D u
+LinearSystem = collections.namedtuple('LinearSystem', 'A B C D')
+
+def biquad(kind, freq, fs, q=0.7071):
+    """Returns a lowpass, highpass or bandpass biquad, from the RBJ Audio EQ Cookbook."""
+    # past either end the poles leave the unit circle and it blows up
+    if not 0 < freq < fs/2.0:
+        raise ValueError("a %s filter at %g Hz needs to be between 0 and %g Hz at %d Hz"
+                         % (kind, freq, fs/2.0, fs))
+    if q <= 0:
+        raise ValueError("a %s filter needs a Q above 0, not %g" % (kind, q))
+
+    w = 2*math.pi*freq/fs
+    alpha = math.sin(w)/(2*q)
+    cos = math.cos(w)
+
+    if kind == 'lowpass':
+        b = ((1 - cos)/2, 1 - cos, (1 - cos)/2)
+    elif kind == 'highpass':
+        b = ((1 + cos)/2, -(1 + cos), (1 + cos)/2)
+    elif kind == 'bandpass':
+        b = (alpha, 0, -alpha) # 0 dB at the peak
+    else:
+        raise ValueError("unknown filter %r" % kind)
+    a0, a1, a2 = 1 + alpha, -2*cos, 1 - alpha
+
+    b0, b1, b2 = [x/a0 for x in b]
+    a1 /= a0
+    a2 /= a0
+
+    # transposed direct form II
+    return LinearSystem(numpy.array([[-a1, 1.0], [-a2, 0.0]]), numpy.array([b1 - a1*b0, b2 - a2*b0]),
+                        numpy.array([1.0, 0.0]), b0)
+
+
+def formant(vowel, fs, q=8.0):
+    """Returns a bank of bandpass filters at a vowel's formants."""
+    formants = VOWELS[vowel]
+    total = sum([gain for freq, gain in formants])
+    return parallel([biquad('bandpass', freq, fs, q) for freq, gain in formants],
+                    [gain/total for freq, gain in formants])
+
+
+def series(systems):
+    """Returns the system that runs each of the given ones into the next."""
+    first = systems[0]
+    for second in systems[1:]:
+        k1, k2 = len(first.B), len(second.B)
+        A = numpy.zeros((k1 + k2, k1 + k2))
+        A[:k1, :k1] = first.A
+        A[k1:, :k1] = numpy.outer(second.B, first.C)
+        A[k1:, k1:] = second.A
+        first = LinearSystem(A, numpy.concatenate((first.B, second.B*first.D)),
+                             numpy.concatenate((second.D*first.C, second.C)), second.D*first.D)
+    return first
+
+
+def parallel(systems, gains):
+    """Returns the system that mixes the outputs of the given ones."""
+    k = sum([len(system.B) for system in systems])
+    A = numpy.zeros((k, k))
+    i = 0
+    for system in systems:
+        j = i + len(system.B)
+        A[i:j, i:j] = system.A
+        i = j
+    return LinearSystem(A, numpy.concatenate([system.B for system in systems]),
+                        numpy.concatenate([gain*system.C for system, gain in zip(systems, gains)]),
+                        sum([gain*system.D for system, gain in zip(systems, gains)]))
+
+
+def parse_filter(spec):
+    """Turns "lowpass:1200", "bandpass:800:2" or "formant:a" into a filter tuple for FilterChain."""
+    parts = spec.split(':')
+    if parts[0] not in FILTERS or len(parts) < 2:
+        raise ValueError("bad filter %r" % spec)
+    if parts[0] == 'formant':
+        if parts[1] not in VOWELS:
+            raise ValueError("unknown vowel %r" % parts[1])
+        return tuple(parts[:2])
+    try:
+        values = [float(x) for x in parts[1:3]]
+    except ValueError:
+        raise ValueError("bad filter %r" % spec)
+    if min(values) <= 0:
+        raise ValueError("bad filter %r, the frequency and Q need to be above 0" % spec)
+    return (parts[0],) + tuple(values)
+
+
+def filter_system(filters, fs):
+    """Returns the LinearSystem for a series of filter tuples, raising ValueError for any that can't run at fs."""
+    systems = []
+    for f in filters:
+        if f[0] == 'formant':
+            systems.append(formant(f[1], fs))
+        else:
+            systems.append(biquad(f[0], f[1], fs, *f[2:]))
+    return series(systems)
+
+
+class FilterChain(object):
+    """Filters the output a block at a time through a series of filters.
+
+    Each filter is a tuple like ('lowpass', 1200), ('bandpass', 800, 2) with
+    the Q last, or ('formant', 'a').  The whole chain is folded into one
+    linear system, and that's unrolled into a matrix taking the input block
+    and the state at its start to the output block and the state at its
+    end.  So a block costs one matrix-vector product however many filters
+    there are, with no per-sample loop, and the state carries on from one
+    block to the next.
+    """
+
+    def __init__(self, filters, fs, block_size=BLOCK_SIZE):
+        self.filters = tuple(filters)
+        self.fs = fs
+        self.block_size = block_size
+
+        self.system = filter_system(self.filters, fs)
+        self.state = numpy.zeros(len(self.system.B))
+
+        self._matrices = {}
+        self._work = numpy.empty(FILTER_BLOCK + len(self.state))
+        self._matrix(min(block_size, FILTER_BLOCK)) # build it now rather than in the audio thread
+
+
+    def _matrix(self, n):
+        matrix = self._matrices.get(n)
+        if matrix is not None:
+            return matrix
+
+        A, B, C, D = self.system
+        k = len(B)
+        powers = numpy.empty((n + 1, k, k)) # A**0 to A**n
+        powers[0] = numpy.identity(k)
+        for i in range(n):
+            powers[i + 1] = A.dot(powers[i])
+
+        # the impulse response down the diagonals
+        h = numpy.empty(n)
+        h[0] = D
+        h[1:] = powers[:n - 1].dot(B).dot(C)
+        lag = numpy.subtract.outer(numpy.arange(n), numpy.arange(n))
+        response = numpy.where(lag >= 0, h[numpy.maximum(lag, 0)], 0.0)
+
+        matrix = numpy.empty((n + k, n + k))
+        matrix[:n, :n] = response
+        matrix[:n, n:] = numpy.dot(C, powers[:n])
+        matrix[n:, :n] = powers[n - 1::-1].dot(B).T
+        matrix[n:, n:] = powers[n]
+
+        self._matrices[n] = matrix
+        return matrix
+
+
+    def take_state(self, other):
+        """Carries on from where another chain with the same filters left off."""
+        if other is not None and len(other.state) == len(self.state):
+            self.state = other.state.copy()
+
+
+    def process(self, block):
+        """Returns the filtered block."""
+        out = numpy.empty(len(block))
+        work = self._work
+        k = len(self.state)
+        for start in range(0, len(block), FILTER_BLOCK):
+            chunk = block[start:start + FILTER_BLOCK]
+            n = len(chunk)
+            work[:n] = chunk
+            work[n:n + k] = self.state
+            result = self._matrix(n).dot(work[:n + k])
+            out[start:start + n] = result[:n]
+            self.state = result[n:]
+
+        numpy.clip(out, -1, 1, out) # resonances can overshoot
+        return out
+
+
+class DelayLine(object):
+    """A circular buffer of the last so many samples."""
+
+    def __init__(self, length):
+        self.buf = numpy.zeros(length)
+        self.pos = 0 # where the next sample goes
+
+
+    def write(self, block):
+        buf = self.buf
+        n = len(block)
+        end = self.pos + n
+        if end <= len(buf):
+            buf[self.pos:end] = block
+        else:
+            split = len(buf) - self.pos
+            buf[self.pos:] = block[:split]
+            buf[:n - split] = block[split:]
+        self.pos = end % len(buf)
+
+
+    def read(self, delay, out):
+        """Fills out with the samples from delay samples back, which must be at least len(out)."""
+        buf = self.buf
+        n = len(out)
+        start = (self.pos - delay) % len(buf)
+        end = start + n
+        if end <= len(buf):
+            out[:] = buf[start:end]
+        else:
+            split = len(buf) - start
+            out[:split] = buf[start:]
+            out[split:] = buf[:n - split]
+        return out
+
+
+    def clear(self):
+        self.buf[:] = 0
+
+
+class Vibrato(object):
+    """Wobbles the pitch by reading a delay line from a point that swings back and forth."""
+
+    rate = 5.5 # Hz
+    depth = 0.01 # the furthest the pitch goes off, as a fraction of it
+
+    def __init__(self, fs, block_size=BLOCK_SIZE):
+        self.swing = self.depth*fs/(2*math.pi*self.rate) # in samples
+        self.line = DelayLine(block_size + int(2*self.swing) + 2)
+        self.inc = self.rate/float(fs)
+        self.phase = 0.0
+
+        self.ramp = numpy.arange(block_size, dtype=numpy.float64)
+        self.pos = numpy.empty(block_size)
+        self.index = numpy.empty(block_size, dtype=numpy.intp)
+        self.y0 = numpy.empty(block_size)
+        self.y1 = numpy.empty(block_size)
+
+
+    def clear(self):
+        self.line.clear()
+
+
+    def process(self, block):
+        n = len(block)
+        line = self.line
+        start = line.pos
+        line.write(block)
+
+        # how far back to read each sample from
+        ramp, pos = self.ramp[:n], self.pos[:n]
+        numpy.multiply(ramp, 2*math.pi*self.inc, pos)
+        pos += 2*math.pi*self.phase
+        numpy.sin(pos, pos)
+        pos += 1
+        pos *= self.swing
+        self.phase = (self.phase + n*self.inc) % 1.0
+
+        # and so where in the buffer
+        numpy.subtract(ramp, pos, pos)
+        pos += start
+        pos %= len(line.buf)
+
+        index, y0, y1 = self.index[:n], self.y0[:n], self.y1[:n]
+        index[:] = pos
+        pos -= index # just the fraction now
+        line.buf.take(index, out=y0, mode='wrap')
+        index += 1
+        line.buf.take(index, out=y1, mode='wrap')
+        y1 -= y0
+        y1 *= pos
+        numpy.add(y0, y1, block)
+        return block
+
+
+class Tremolo(object):
+    """Wobbles the volume."""
+
+    rate = 6.0 # Hz
+    depth = 0.4 # how far the volume dips
+
+    def __init__(self, fs, block_size=BLOCK_SIZE):
+        self.inc = self.rate/float(fs)
+        self.phase = 0.0
+        self.ramp = numpy.arange(block_size, dtype=numpy.float64)
+        self.gain = numpy.empty(block_size)
+
+
+    def clear(self):
+        pass
+
+
+    def process(self, block):
+        n = len(block)
+        gain = self.gain[:n]
+        numpy.multiply(self.ramp[:n], 2*math.pi*self.inc, gain)
+        gain += 2*math.pi*self.phase
+        numpy.cos(gain, gain)
+        gain *= self.depth/2
+        gain += 1 - self.depth/2
+        self.phase = (self.phase + n*self.inc) % 1.0
+
+        block *= gain
+        return block
+
+
+class Delay(object):
+    """Echoes, each quieter than the last."""
+
+    seconds = 0.3
+    feedback = 0.4 # how much of each echo goes round again
+    mix = 0.5 # how loud the first echo is
+
+    def __init__(self, fs, block_size=BLOCK_SIZE):
+        self.delay = int(self.seconds*fs)
+        self.line = DelayLine(self.delay + block_size)
+        self.echo = numpy.empty(min(block_size, self.delay))
+        self.feed = numpy.empty(min(block_size, self.delay))
+
+
+    def clear(self):
+        self.line.clear()
+
+
+    def process(self, block):
+        # nothing written within a delay's worth of samples comes back
+        # within it, so each stretch that long is a few array operations
+        step = len(self.echo)
+        for start in range(0, len(block), step):
+            x = block[start:start + step]
+            echo = self.line.read(self.delay, self.echo[:len(x)])
+            feed = self.feed[:len(x)]
+            numpy.multiply(echo, self.feedback, feed)
+            feed += x
+            self.line.write(feed)
+            echo *= self.mix
+            x += echo
+        return block
+
+
+class Reverb(object):
+    """A Schroeder reverb: four feedback combs side by side, then two allpasses."""
+
+    combs = (1116, 1188, 1277, 1356) # delays in samples at 44.1 kHz, as in Freeverb
+    comb_feedback = 0.84
+    allpasses = (556, 341)
+    allpass_feedback = 0.5
+    wet = 0.3
+
+    def __init__(self, fs, block_size=BLOCK_SIZE):
+        scale = fs/44100.0
+        self.comb_delays = [int(d*scale) for d in self.combs]
+        self.allpass_delays = [int(d*scale) for d in self.allpasses]
+        self.comb_lines = [DelayLine(d + block_size) for d in self.comb_delays]
+        self.allpass_lines = [DelayLine(d + block_size) for d in self.allpass_delays]
+
+        self.mixed = numpy.empty(block_size)
+        self.delayed = numpy.empty(block_size)
+        self.fed = numpy.empty(block_size)
+
+
+    def clear(self):
+        for line in self.comb_lines + self.allpass_lines:
+            line.clear()
+
+
+    def process(self, block):
+        n = len(block)
+        mixed = self.mixed[:n]
+        mixed[:] = 0
+        for delay, line in zip(self.comb_delays, self.comb_lines):
+            self._feedback(block, mixed, delay, line, self.comb_feedback, 1.0/len(self.combs))
+
+        for delay, line in zip(self.allpass_delays, self.allpass_lines):
+            self._feedback(mixed, mixed, delay, line, self.allpass_feedback, None)
+
+        mixed *= self.wet
+        block += mixed
+        return block
+
+
+    def _feedback(self, x, out, delay, line, g, gain):
+        # Both keep v[n] = x[n] + g*v[n - delay] in the line.  A comb (with a
+        # gain) adds gain*v[n] to out, an allpass puts v[n - delay] - g*v[n]
+        # in it.  Like Delay, a stretch up to the delay long at a time.
+        for start in range(0, len(x), delay):
+            end = min(start + delay, len(x))
+            delayed = line.read(delay, self.delayed[:end - start])
+            fed = self.fed[:end - start]
+            numpy.multiply(delayed, g, fed)
+            fed += x[start:end]
+            line.write(fed)
+
+            if gain is None:
+                fed *= -g
+                fed += delayed
+                out[start:end] = fed
+            else:
+                fed *= gain
+                out[start:end] += fed
+
+
+class EffectsChain(object):
+    """Runs the output through the effects in EFFECTS order, skipping any that are bypassed.
+
+    The effects work in place on buffers allocated up front, and each one's
+    CPU time goes into a Histogram.
+    """
+
+    classes = {'vibrato': Vibrato, 'tremolo': Tremolo, 'delay': Delay, 'reverb': Reverb}
+
+    def __init__(self, fs, block_size=BLOCK_SIZE, enabled=()):
+        for name in enabled:
+            if name not in EFFECTS:
+                raise ValueError("unknown effect %r" % name)
+
+        self.effects = [(name, self.classes[name](fs, block_size)) for name in EFFECTS]
+        self.bypassed = dict((name, name not in enabled) for name in EFFECTS)
+        self.times = dict((name, Histogram()) for name in EFFECTS)
+        self._running = set(enabled) # what went into the last block
+
+
+    def set_bypass(self, name, bypassed):
+        if name not in self.bypassed:
+            raise ValueError("unknown effect %r" % name)
+        self.bypassed[name] = bypassed
+
+
+    def process(self, block):
+        clock = time.time
+        bypassed = self.bypassed
+        running = self._running
+        for name, effect in self.effects:
+            if bypassed[name]:
+                running.discard(name)
+                continue
+            if name not in running:
+                effect.clear() # no echoes left over from the last time it was on
+                running.add(name)
+
+            start = clock()
+            effect.process(block)
+            self.times[name].add(clock() - start)
+
+        if running:
+            numpy.clip(block, -1, 1, block)
+        return block
+
+
+    def summary(self):
+        """The CPU time taken by each effect that's on."""
+        return dict((name, self.times[name].summary()) for name in EFFECTS if not self.bypassed[name])
+
+
+class Decimator(object):
+    """Brings oversampled audio back down to the output rate.
+
+    A Kaiser-windowed sinc lowpass takes out everything that would fold
+    back below the output's Nyquist frequency, and only the samples kept
+    are worked out, all of a block's at once as one matrix-vector product
+    over overlapping windows of the input.
+    """
+
+    def __init__(self, factor, block_size=BLOCK_SIZE, taps_per_factor=64, beta=8.6):
+        self.factor = factor
+        self.block_size = block_size # of the output
+
+        n = taps_per_factor*factor
+        t = numpy.arange(n) - (n - 1)/2.0
+        taps = numpy.sinc(t/factor)/factor*numpy.kaiser(n, beta)
+        self.taps = (taps/taps.sum())[::-1].copy() # reversed so a dot product convolves
+
+        self.history = n - 1
+        self.buf = numpy.zeros(self.history + factor*block_size)
+        self.out = numpy.empty(block_size)
+
+
+    def process(self, block):
+        """Returns every factor-th sample of the filtered block, in a buffer that's reused."""
+        buf = self.buf
+        history = self.history
+        buf[history:] = block
+
+        # the window ending at the last of each factor samples
+        item = buf.itemsize
+        windows = numpy.lib.stride_tricks.as_strided(buf[self.factor - 1:], (self.block_size, len(self.taps)),
+                                                     (self.factor*item, item))
+        numpy.dot(windows, self.taps, self.out)
+
+        buf[:history] = buf[-history:]
+        return self.out
+
+
+class ToneEngine(object):
+    """Renders the instrument's output a block of samples at a time."""
+
+    def __init__(self, fs, block_size=BLOCK_SIZE, oscillator='zero crossing',
+                 waveform='sine', interpolation='linear', params=None, filters=(), effects=(),
+                 oversample=1):
+        if oversample not in OVERSAMPLING:
+            raise ValueError("can't oversample %r times" % oversample)
+        if oscillator not in OSCILLATORS:
+            raise ValueError("unknown oscillator %r" % oscillator)
+        if waveform not in WAVEFORMS:
+            raise ValueError("unknown waveform %r" % waveform)
+        if interpolation not in INTERPOLATIONS:
+            raise ValueError("unknown interpolation %r" % interpolation)
+
+        self.fs = fs # the sample frequency
+        self.block_size = block_size
+        self.interpolation = interpolation
+        self.params = params or ParamMailbox(waveform=waveform, oscillator=oscillator)
+
+        # the oscillators run this much faster and get decimated
+        self.oversample = oversample
+        self.rate = fs*oversample
+        self.frames = block_size*oversample
+        self.decimator = oversample > 1 and Decimator(oversample, block_size) or None
+
+        params = self.params.snapshot
+        self.oscillator = oscillator # the oscillator and waveform actually in use
+        self.waveform = waveform
+        self._tables = mipmap(waveform, self.rate)
+        self._timestamp = params.timestamp # of the last snapshot rendered
+        self.control_latency = 0.0 # from the last change published to it being rendered, in seconds
+        self.fresh = False # whether the last block was the first with new parameters
+
+        self._ft = params.freq # the frequency that's actually sounding
+        self._vol = params.vol # the volume at the end of the last block
+        self._x = 0 # samples since the sounding frequency started
+        self._phase = 0.0 # position in the current period, from 0 to 1
+
+        self.voices = VoicePool(self.rate, self.frames)
+        self.filter = None
+        self.set_filters(filters)
+        self.effects = EffectsChain(fs, block_size, effects)
+
+
+    def set_new_freq(self, freq, vol, voices=()):
+        """Updates the input frequency, and the (freq, vol) of any voices playing along."""
+        if len(voices) >= MAX_VOICES:
+            raise ValueError("at most %d voices can play at once" % MAX_VOICES)
+        self.params.publish(freq=freq, vol=vol, voices=tuple(voices))
+
+
+    def set_waveform(self, waveform):
+        """Switches to another timbre."""
+        if waveform not in WAVEFORMS:
+            raise ValueError("unknown waveform %r" % waveform)
+        mipmap(waveform, self.rate) # build it here rather than in the audio thread
+        self.params.publish(waveform=waveform)
+
+
+    def set_oscillator(self, oscillator):
+        if oscillator not in OSCILLATORS:
+            raise ValueError("unknown oscillator %r" % oscillator)
+        self.params.publish(oscillator=oscillator)
+
+
+    def set_filters(self, filters):
+        """Replaces the filters the output goes through (see FilterChain), () for none."""
+        chain = None
+        if filters:
+            # build it here rather than in the audio thread, which just picks it up
+            chain = FilterChain(filters, self.fs, self.block_size)
+            chain.take_state(self.filter)
+        self.filter = chain
+
+
+    def set_effect(self, name, on):
+        """Turns an effect on or bypasses it."""
+        self.effects.set_bypass(name, not on)
+
+
+    def _switch_oscillator(self, oscillator):
+        # carry on from the same point in the waveform
+        fs = float(self.rate)
+        if oscillator == 'phase' and self.oscillator != 'phase':
+            self._phase = (self._ft*self._x/fs) % 1.0
+        elif oscillator != 'phase' and self.oscillator == 'phase':
+            if self._ft <= 0:
+                self._x = 0 # silent, so any point will do
+            else:
+                self._x = int(round(self._phase*fs/self._ft))
+
+        self.oscillator = oscillator
+
+
+    def render(self):
+        """Returns the next block of samples as floats between -1 and 1."""
+        params = self.params.snapshot # only read once a block
+        self.fresh = params.timestamp != self._timestamp
+        if self.fresh:
+            self._timestamp = params.timestamp
+            self.control_latency = time.time() - params.timestamp
+
+            if params.oscillator != self.oscillator:
+                self._switch_oscillator(params.oscillator)
+            if params.waveform != self.waveform:
+                self._tables = mipmap(params.waveform, self.rate)
+                self.waveform = params.waveform
+
+        # the table for the highest the block goes, whether it's sliding or switching
+        level = mipmap_level(max(self._ft, params.freq), len(self._tables))
+
+        if self.oscillator == 'phase':
+            phases, gain = self._ramped_phases(self.frames, params.freq, params.vol)
+        else:
+            phases, gain = self._zero_crossing_phases(self.frames, params.freq, params.vol)
+
+        if self.waveform == 'sine':
+            # a vectorized sin is still cheaper than a table lookup
+            block = numpy.sin(2*math.pi*phases)
+        else:
+            block = wavetable_lookup(self._tables[level], phases, self.interpolation)
+        block *= gain
+        if params.voices or self.voices.active:
+            block += self.voices.render(params.voices, self.waveform, self._tables, self.interpolation)
+        block *= 0.95 # don't max out the range otherwise we clip
+
+        if self.decimator is not None:
+            block = self.decimator.process(block).copy()
+
+        chain = self.filter
+        if chain is not None:
+            block = chain.process(block)
+        return self.effects.process(block)
+
+
+    def _zero_crossing_phases(self, n, ft, vol):
+        fs = float(self.rate)
+        x = numpy.arange(self._x, self._x + n, dtype=numpy.float64)
+        phases = numpy.empty(n)
+
+        # The idea here is to keep the waveform continuous by only changing
+        # the frequency at the end of the previous frequency's period.  A new
+        # period starts wherever the whole number of cycles goes up by one.
+        switch = n
+        if ft != self._ft and self._ft <= 0:
+            switch = 0 # nothing's sounding, so there's no period to wait out
+        elif ft != self._ft:
+            cycles = numpy.floor(self._ft*numpy.arange(self._x - 1, self._x + n)/fs)
+            starts = numpy.flatnonzero(numpy.diff(cycles))
+            if len(starts):
+                switch = starts[0]
+
+        phases[:switch] = self._ft*x[:switch]/fs
+        if switch < n:
+            self._ft = ft
+            self._x = n - switch
+            phases[switch:] = ft*numpy.arange(n - switch)/fs
+        else:
+            self._x += n
+
+        phases %= 1.0
+
+        self._vol = vol
+        return phases, vol
+
+
+    def _ramped_phases(self, n, ft, vol):
+        # Keep a wrapped phase accumulator and slide the frequency and volume
+        # from where the last block left off to the new values, so changes
+        # happen within a block without clicks or waiting for a zero crossing.
+        freqs = numpy.linspace(self._ft, ft, n + 1)[1:]
+        incs = freqs/float(self.rate)
+        phases = numpy.cumsum(incs)
+        end = self._phase + phases[-1]
+        phases -= incs
+        phases += self._phase
+        phases %= 1.0
+
+        gains = numpy.linspace(self._vol, vol, n + 1)[1:]
+
+        self._phase = end % 1.0
+        self._ft = ft
+        self._vol = vol
+        return phases, gains
+
+
+class AudioFormat(collections.namedtuple('AudioFormat', 'rate format channels')):
+    """What audio going to a device or file looks like: frames a second, a sample format and channels.
+
+    The engine renders mono floats at the rate, and encode() turns them into
+    frames of this format with the same sound in every channel.
+    """
+
+    __slots__ = ()
+
+    dtypes = {'s16': numpy.dtype('<i2'), 's32': numpy.dtype('<i4'), 'float32': numpy.dtype('<f4')}
+    scales = {'s16': 2**15 - 1, 's32': 2**31 - 1, 'float32': 1}
+
+    def __new__(cls, rate=44100, format='s16', channels=1):
+        if format not in SAMPLE_FORMATS:
+            raise ValueError("unknown sample format %r" % format)
+        if channels < 1:
+            raise ValueError("there has to be at least one channel")
+        return super(AudioFormat, cls).__new__(cls, rate, format, channels)
+
+
+    @property
+    def dtype(self):
+        return self.dtypes[self.format]
+
+
+    @property
+    def frame_size(self):
+        """Bytes per frame."""
+        return self.dtype.itemsize*self.channels
+
+
+    def encode(self, block):
+        """Converts a block of floats between -1 and 1 to an array of frames, one row each if there's more than one channel."""
+        scaled = numpy.clip(block, -1, 1)*self.scales[self.format]
+        if self.channels == 1:
+            return scaled.astype(self.dtype)
+
+        frames = numpy.empty((len(block), self.channels), self.dtype)
+        frames[:] = scaled[:, None]
+        return frames
+
+
+DEFAULT_FORMAT = AudioFormat(44100, 's16', 1)
+
+WAVE_FORMAT_IEEE_FLOAT = 3
+
+class FloatWaveWriter(wave.Wave_write):
+    """A wave writer for 32-bit float samples, which the wave module only knows to write as PCM."""
+
+    def _write_header(self, initlength):
+        assert not self._headerwritten
+        self._file.write('RIFF')
+        if not self._nframes:
+            self._nframes = initlength / (self._nchannels * self._sampwidth)
+        self._datalength = self._nframes * self._nchannels * self._sampwidth
+        self._form_length_pos = self._file.tell()
+        self._file.write(struct.pack('<L4s4sLHHLLHH4s',
+            36 + self._datalength, 'WAVE', 'fmt ', 16,
+            WAVE_FORMAT_IEEE_FLOAT, self._nchannels, self._framerate,
+            self._nchannels * self._framerate * self._sampwidth,
+            self._nchannels * self._sampwidth,
+            self._sampwidth * 8, 'data'))
+        self._data_length_pos = self._file.tell()
+        self._file.write(struct.pack('<L', self._datalength))
+        self._headerwritten = True
+
+
+def open_wave(f, format):
+    """Opens a WAV file (a filename or a file object) for writing audio of the given AudioFormat."""
+    if format.format == 'float32':
+        output = FloatWaveWriter(f)
+    else:
+        output = wave.open(f, 'w')
+    output.setnchannels(format.channels)
+    output.setsampwidth(format.dtype.itemsize)
+    output.setframerate(format.rate)
+    return output
+
+
+class Resampler(object):
+    """Converts a stream of blocks from one sample rate to another with a polyphase FIR.
+
+    The rates' ratio is taken as up/down, the lowpass prototype is split
+    into up phases of a few taps each, and every output sample only works
+    out the one phase it lands on.  The cost is a fixed number of taps per
+    output sample, so it's bounded per second of audio whatever the rates.
+    The last few input samples and the position between them carry on
+    from one block to the next.
+    """
+
+    def __init__(self, rate_in, rate_out, taps=32, beta=8.6, max_phases=1024):
+        self.rate_in = rate_in
+        self.rate_out = rate_out
+
+        # a close enough ratio if the exact one would take too many phases
+        ratio = fractions.Fraction(rate_in, rate_out).limit_denominator(max_phases)
+        self.up, self.down = ratio.denominator, ratio.numerator
+
+        n = self.up*taps
+        t = numpy.arange(n) - (n - 1)/2.0
+        cutoff = 0.5/max(self.up, self.down)*0.95 # in cycles per upsampled sample
+        h = 2*cutoff*numpy.sinc(2*cutoff*t)*numpy.kaiser(n, beta)
+        h *= self.up/h.sum()
+
+        # phase p's taps, reversed to line up with the input they're applied to
+        self.phases = h.reshape(taps, self.up).T[:, ::-1].copy()
+        self.taps = taps
+
+        self.history = numpy.zeros(taps - 1)
+        self.pos = 0 # of the next output sample in upsampled units, from the start of the next block
+        self._offsets = numpy.arange(taps)
+
+
+    def process(self, block):
+        """Returns as much of the resampled stream as the block allows, about len(block)*rate_out/rate_in samples."""
+        taps = self.taps
+        buf = numpy.concatenate((self.history, block))
+
+        # every output sample whose newest input is in this block
+        end = len(block)*self.up
+        count = max(0, (end - self.pos + self.down - 1)//self.down)
+        pos = self.pos + self.down*numpy.arange(count)
+        index, phase = numpy.divmod(pos, self.up)
+
+        windows = buf[index[:, None] + self._offsets]
+        out = numpy.einsum('ij,ij->i', windows, self.phases[phase])
+
+        self.pos += self.down*count - end
+        self.history = buf[len(buf) - (taps - 1):]
+        return out
+
+
+# from <linux/soundcard.h>, asks for the size of a fragment (what OSS calls a period)
+SNDCTL_DSP_GETBLKSIZE = 0xc0045004
+
+class OSSSink(object):
+    """Plays through an OSS device such as /dev/dsp."""
+
+    # AFMT_* values, ossaudiodev only knows the older ones
+    formats = {'s16': ossaudiodev.AFMT_S16_LE, 's32': 0x00001000, 'float32': 0x00004000}
+
+    def __init__(self, device, format):
+        self.dsp = ossaudiodev.open(device, 'w')
+        fmt, channels, fs = self.dsp.setparameters(self.formats[format.format], format.channels, format.rate)
+        if fmt != self.formats[format.format] or channels != format.channels:
+            self.dsp.close()
+            raise IOError("%s can't play %d channel %s" % (device, format.channels, format.format))
+        self.format = format._replace(rate=fs) # the rate the device actually took
+        self.fs = fs
+        self.buffer_frames = self.dsp.bufsize()
+
+        try:
+            frag = fcntl.ioctl(self.dsp.fileno(), SNDCTL_DSP_GETBLKSIZE, struct.pack('i', 0))
+            self.period_size = struct.unpack('i', frag)[0]/self.format.frame_size
+        except IOError:
+            self.period_size = self.buffer_frames
+
+
+    def wait(self, frames, timeout):
+        """Sleeps until the device can take the given number of frames without blocking, or the timeout runs out."""
+        frames = min(frames, self.buffer_frames)
+        free = self.dsp.obuffree()
+        if free >= frames:
+            return True
+
+        # the driver says the device is writable as soon as a fragment is
+        # free, which may still be short of a block, so after that sleep
+        # for about as long as it takes the rest to drain
+        readable, writable, errors = select.select([], [self.dsp], [], 0)
+        if not writable:
+            select.select([], [self.dsp], [], min(timeout, float(frames)/self.fs))
+        else:
+            time.sleep(min(timeout, float(frames - free)/self.fs))
+
+        return self.dsp.obuffree() >= frames
+
+
+    def write(self, data):
+        self.dsp.write(data)
+
+
+    def latency(self):
+        """The time until a sample written now gets played, in seconds."""
+        return float(self.dsp.obufcount())/self.fs
+
+
+    def close(self):
+        self.dsp.close()
+
+
+class ALSASink(object):
+    """Plays through an ALSA device using libasound, which is loaded with ctypes.
+
+    The "default" device goes through PulseAudio on systems that run it.
+    """
+
+    SND_PCM_STREAM_PLAYBACK = 0
+    SND_PCM_ACCESS_RW_INTERLEAVED = 3
+
+    # SND_PCM_FORMAT_* values
+    formats = {'s16': 2, 's32': 10, 'float32': 14}
+
+    def __init__(self, device, format, latency=0.05):
+        import ctypes
+        import ctypes.util
+
+        libname = ctypes.util.find_library('asound')
+        if libname is None:
+            raise IOError("can't find libasound, is ALSA installed?")
+
+        self.lib = lib = ctypes.CDLL(libname)
+        lib.snd_strerror.restype = ctypes.c_char_p
+        lib.snd_pcm_avail.restype = ctypes.c_long
+        lib.snd_pcm_writei.restype = ctypes.c_long
+        lib.snd_pcm_writei.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_ulong]
+
+        self.ctypes = ctypes
+        self.format = format
+        self.fs = format.rate
+        self.pcm = ctypes.c_void_p()
+        self._check(lib.snd_pcm_open(ctypes.byref(self.pcm), device, self.SND_PCM_STREAM_PLAYBACK, 0))
+        self._check(lib.snd_pcm_set_params(self.pcm, self.formats[format.format],
+                                           self.SND_PCM_ACCESS_RW_INTERLEAVED,
+                                           format.channels, format.rate, 1, int(latency*1000000)))
+
+        buffer_size = ctypes.c_ulong()
+        period_size = ctypes.c_ulong()
+        self._check(lib.snd_pcm_get_params(self.pcm, ctypes.byref(buffer_size), ctypes.byref(period_size)))
+        self.buffer_frames = buffer_size.value
+        self.period_size = period_size.value
+
+
+    def _check(self, err):
+        if err < 0:
+            raise IOError(err, self.lib.snd_strerror(err))
+        return err
+
+
+    def _avail(self):
+        avail = self.lib.snd_pcm_avail(self.pcm)
+        if avail < 0:
+            # an underrun, get the stream going again
+            self._check(self.lib.snd_pcm_recover(self.pcm, int(avail), 1))
+            avail = self.lib.snd_pcm_avail(self.pcm)
+        return avail
+
+
+    def wait(self, frames, timeout):
+        """Sleeps until the device can take the given number of frames without blocking, or the timeout runs out."""
+        frames = min(frames, self.buffer_frames)
+        if self._avail() >= frames:
+            return True
+
+        self.lib.snd_pcm_wait(self.pcm, int(timeout*1000))
+        return self._avail() >= frames
+
+
+    def write(self, data):
+        frames = len(data)/self.format.frame_size
+        written = self.lib.snd_pcm_writei(self.pcm, data, frames)
+        if written < 0:
+            self._check(self.lib.snd_pcm_recover(self.pcm, int(written), 1))
+            self._check(self.lib.snd_pcm_writei(self.pcm, data, frames))
+
+
+    def latency(self):
+        """The time until a sample written now gets played, in seconds."""
+        delay = self.ctypes.c_long()
+        if self.lib.snd_pcm_delay(self.pcm, self.ctypes.byref(delay)) < 0:
+            return 0.0
+        return float(delay.value)/self.fs
+
+
+    def close(self):
+        self.lib.snd_pcm_drain(self.pcm)
+        self.lib.snd_pcm_close(self.pcm)
+
+
+class NullSink(object):
+    """Throws the audio away, but takes it no faster than a sound card would.
+
+    Pass realtime=False to take it as fast as it can be rendered.
+    """
+
+    def __init__(self, format, buffer_frames=4096, realtime=True):
+        self.format = format
+        self.fs = format.rate
+        self.buffer_frames = buffer_frames
+        self.period_size = buffer_frames/4
+        self.realtime = realtime
+
+        self._start = None # when the first frame since the last underrun was "played"
+        self._frames = 0 # frames written since then
+
+
+    def _queued(self):
+        if self._start is None:
+            return 0
+
+        queued = self._frames - (time.time() - self._start)*self.fs
+        if queued < 0:
+            # underrun, start counting over
+            self._start = None
+            self._frames = 0
+            return 0
+
+        return queued
+
+
+    def wait(self, frames, timeout):
+        """Sleeps until the device can take the given number of frames without blocking, or the timeout runs out."""
+        if not self.realtime:
+            return True
+
+        frames = min(frames, self.buffer_frames)
+        delay = float(self._queued() + frames - self.buffer_frames)/self.fs
+        if delay > 0:
+            time.sleep(min(delay, timeout))
+        return delay <= timeout
+
+
+    def write(self, data):
+        if self._start is None:
+            self._start = time.time()
+        self._frames += len(data)/self.format.frame_size
+        self._write(data)
+
+
+    def _write(self, data):
+        pass
+
+
+    def latency(self):
+        """The time until a sample written now gets played, in seconds."""
+        return float(self._queued())/self.fs
+
+
+    def close(self):
+        pass
+
+
+class WaveFileSink(NullSink):
+    """Writes the audio to a WAV file."""
+
+    def __init__(self, filename, format, realtime=True):
+        NullSink.__init__(self, format, realtime=realtime)
+        self.output = open_wave(filename, format)
+
+
+    def _write(self, data):
+        self.output.writeframes(data)
+
+
+    def close(self):
+        self.output.close()
+
+
+class RawFileSink(NullSink):
+    """Writes the audio to a file as bare little-endian samples."""
+
+    def __init__(self, filename, format, realtime=True):
+        NullSink.__init__(self, format, realtime=realtime)
+        self.output = open(filename, 'wb')
+
+
+    def _write(self, data):
+        self.output.write(data)
+
+
+    def close(self):
+        self.output.close()
+
+
+def open_sink(backend, device, format=DEFAULT_FORMAT):
+    """Opens an audio output by backend name (see BACKENDS) for an AudioFormat.
+
+    The sink's format attribute says what it actually took.
+    """
+    if backend == 'oss':
+        if device == '/dev/null':
+            return NullSink(format)
+        return OSSSink(device, format)
+    elif backend == 'alsa':
+        return ALSASink(device, format)
+    elif backend == 'wav':
+        return WaveFileSink(device, format)
+    elif backend == 'raw':
+        return RawFileSink(device, format)
+    elif backend == 'null':
+        return NullSink(format)
+    else:
+        raise ValueError("unknown backend %r" % backend)
+
+
+class Recording(object):
+    """Audio recorded while playing, kept in preallocated fixed-size chunks.
+
+    Once more than max_frames are held in memory the oldest chunk is handed
+    to a writer thread that spills it to a temporary file, or with ring=True
+    thrown away so that only the last max_frames are kept.  A chunk's buffer
+    is only reused once it's on disk or thrown away, and not while chunks()
+    is being read.  A couple are kept spare for the writer and exports to
+    catch up with, so appending never allocates or waits on the disk.
+    close() stops the writer.
+    """
+
+    spare = 2 # chunks kept free while the writer or an export catches up
+    spill_interval = 0.1 # seconds between the writer's looks at its queue
+
+    def __init__(self, max_frames=RECORDING_FRAMES, ring=False, chunk_size=RECORDING_CHUNK, dtype=numpy.int16,
+                 channels=1):
+        self.chunk_size = chunk_size
+        self.dtype = numpy.dtype(dtype)
+        self.channels = channels
+        self.ring = ring
+
+        # numpy.empty only reserves address space, the pages get allocated
+        # by the OS as they're first written.  A row a frame with more than
+        # one channel, the way AudioFormat.encode() makes them.
+        nchunks = max(2, max_frames/chunk_size)
+        self._shape = channels > 1 and (chunk_size, channels) or chunk_size
+        self._free = [numpy.empty(self._shape, self.dtype) for i in range(nchunks + self.spare)]
+        self._full = collections.deque() # (index, chunk) for the full chunks in memory, oldest first
+        self._max_full = nchunks - 1
+        self._current = (0, self._free.pop()) # the chunk being filled
+        self._pos = 0 # frames used in it
+
+        self._spilled = 0 # frames spilled to disk or on their way
+        self._written = 0 # chunks in the spill file
+        self.dropped = 0 # frames thrown away
+        self.error = None # why the spill file couldn't be written, if it couldn't
+
+        self._exporting = 0 # chunks() generators running
+        self._export_lock = threading.Lock() # for them, the audio thread only reads the count
+        self._held = [] # chunks done with while something was exporting
+
+        self._spill = None
+        self._spilling = collections.deque() # (index, chunk) waiting for the writer
+        self._alive = True
+        if not ring:
+            self._spill = tempfile.NamedTemporaryFile(prefix='ptheremin-')
+            writer = threading.Thread(target=self._write_spills, name="recording spill")
+            writer.daemon = True
+            writer.start()
+
+
+    def append(self, samples):
+        """Adds a block of samples to the end of the recording."""
+        start = 0
+        n = len(samples)
+        while start < n:
+            count = min(n - start, self.chunk_size - self._pos)
+            self._current[1][self._pos:self._pos + count] = samples[start:start + count]
+            self._pos += count
+            start += count
+
+            if self._pos == self.chunk_size:
+                self._next_chunk()
+
+
+    def _next_chunk(self):
+        index = self._current[0]
+        self._full.append(self._current)
+        self._pos = 0
+
+        if len(self._full) > self._max_full:
+            oldest = self._full.popleft()
+            if self.ring or self.error:
+                self.dropped += self.chunk_size
+                self._recycle(oldest[1])
+            else:
+                self._spilling.append(oldest)
+                self._spilled += self.chunk_size
+
+        try:
+            chunk = self._free.pop()
+        except IndexError:
+            # the writer or an export has fallen a long way behind, more
+            # memory beats a gap
+            chunk = numpy.empty(self._shape, self.dtype)
+        self._current = (index + 1, chunk)
+
+
+    def _recycle(self, chunk):
+        if self._exporting:
+            self._held.append(chunk) # it may be in an export's snapshot
+        else:
+            self._free.append(chunk)
+
+
+    def _write_spills(self):
+        queue = self._spilling
+        try:
+            while self._alive or queue:
+                while queue:
+                    index, chunk = queue[0]
+                    self._spill.write(buffer(chunk))
+                    self._spill.flush()
+                    self._written += 1
+                    queue.popleft() # only now, so chunks() always finds it one place or the other
+                    self._recycle(chunk)
+
+                time.sleep(self.spill_interval)
+        except (IOError, OSError), e:
+            # from now on the oldest chunks get thrown away instead
+            self.error = e
+            while queue:
+                self.dropped += self.chunk_size
+                self._recycle(queue.popleft()[1])
+
+
+    def close(self):
+        """Stops the spill writer once it's caught up.  The recording can still be read."""
+        self._alive = False
+
+
+    def __len__(self):
+        return self._spilled + len(self._full)*self.chunk_size + self._pos
+
+
+    def chunks(self):
+        """Yields the recording as arrays of at most chunk_size samples, oldest first."""
+        # nothing in the snapshot gets reused until this is done with it
+        self._export_lock.acquire()
+        self._exporting += 1
+        self._export_lock.release()
+        try:
+            for chunk in self._snapshot_chunks():
+                yield chunk
+        finally:
+            self._export_lock.acquire()
+            self._exporting -= 1
+            if not self._exporting:
+                while self._held:
+                    self._free.append(self._held.pop())
+            self._export_lock.release()
+
+
+    def _snapshot_chunks(self):
+        # take a snapshot first since the audio thread keeps appending.  A
+        # chunk goes from current to full to spilling to the file, so looking
+        # in that order finds it at least once, and its index weeds out the
+        # times it's found twice.
+        index, current = self._current
+        pos = self._pos
+        full = list(self._full)
+        spilling = list(self._spilling)
+        written = self._written
+
+        if written:
+            spill = open(self._spill.name, 'rb')
+            try:
+                for i in range(written):
+                    data = spill.read(self.chunk_size*self.channels*self.dtype.itemsize)
+                    yield numpy.frombuffer(data, self.dtype).reshape(self._shape)
+            finally:
+                spill.close()
+
+        wanted = written # the index of the next chunk to yield
+        for i, chunk in spilling + full:
+            if i >= wanted:
+                yield chunk
+                wanted = i + 1
+
+        if pos and index >= wanted:
+            yield current[:pos]
+
+
+class ExportThread(threading.Thread):
+    """Writes a recording out to a WAV file in the background.
+
+    Progress (from 0 to 1) can be read from the progress attribute while it
+    runs, and cancel() stops it after the chunk being written.
+    """
+
+    def __init__(self, recording, filename, format=DEFAULT_FORMAT):
+        threading.Thread.__init__(self, name="export")
+        self.recording = recording
+        self.filename = filename
+        self.format = format
+
+        self.progress = 0.0
+        self.cancelled = False
+        self.error = None
+
+
+    def cancel(self):
+        self.cancelled = True
+
+
+    def run(self):
+        try:
+            output = open_wave(self.filename, self.format)
+            try:
+                n = len(self.recording)
+                output.setnframes(n) # so the header doesn't get patched on every write
+
+                done = 0
+                for chunk in self.recording.chunks():
+                    if self.cancelled:
+                        break
+
+                    # buffer() hands wave the chunk's memory without a copy
+                    output.writeframes(buffer(chunk))
+                    done += len(chunk)
+                    self.progress = min(1.0, float(done)/max(n, 1))
+            finally:
+                output.close()
+        except (IOError, OSError, wave.Error), e:
+            self.error = e
+
+
+class DiskRecorder(threading.Thread):
+    """Streams audio to a WAV file while it plays.
+
+    The audio thread hands over blocks with put(), which only appends to a
+    deque so it never waits on a lock.  This thread wakes up about once a
+    block to write out whatever has queued up.  wave rewrites the header on
+    every write, so the file is always playable up to the last block.
+
+    The file is opened straight away so the caller hears if it can't be.
+    If a write fails later, error is set and alive goes false.
+    """
+
+    def __init__(self, filename, format=DEFAULT_FORMAT, interval=None):
+        threading.Thread.__init__(self, name="disk recorder")
+        self.filename = filename
+        self.format = format
+        self.interval = interval or float(BLOCK_SIZE)/format.rate
+
+        self.file = open(filename, 'wb')
+        try:
+            self.output = open_wave(self.file, format)
+        except:
+            self.file.close()
+            raise
+
+        self.queue = collections.deque()
+        self.alive = True
+        self.error = None
+
+
+    def put(self, samples):
+        self.queue.append(samples)
+
+
+    def stop(self):
+        self.alive = False
+
+
+    def run(self):
+        f, output = self.file, self.output
+        queue = self.queue
+        try:
+            while self.alive or queue:
+                while queue:
+                    output.writeframes(buffer(queue.popleft()))
+                f.flush()
+
+                time.sleep(self.interval)
+
+            output.close()
+        except (IOError, OSError, wave.Error), e:
+            self.error = e
+            self.alive = False # so the audio thread stops handing it blocks
+            queue.clear()
+            try:
+                output.close() # fails too, but lets go of the file
+            except (IOError, OSError, wave.Error):
+                pass
+
+        f.close()
+
+
+class Histogram(object):
+    """Counts values into power-of-two buckets, cheap enough to update from the audio thread."""
+
+    def __init__(self, unit=1e-6, buckets=32):
+        self.unit = unit # the upper edge of the first bucket
+        self.buckets = [0]*buckets
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        bucket = min(int(value/self.unit).bit_length(), len(self.buckets) - 1)
+        self.buckets[bucket] += 1
+
+
+    def percentile(self, pct):
+        """Returns an upper bound on the given percentile."""
+        wanted = self.count*pct/100.0
+        seen = 0
+        for i,n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= wanted:
+                return min(self.unit*2**i, self.max)
+        return self.max
+
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.count and self.total/self.count,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            'max': self.max,
+        }
+
+
+class EngineStats(object):
+    """What the audio thread has been up to.  Times are all in seconds."""
+
+    def __init__(self):
+        self.started = time.time()
+        self.blocks = 0
+        self.underruns = 0
+        self.render_time = Histogram() # to render a block
+        self.device_fill = Histogram() # audio queued in the device when a block is written
+        self.control_latency = Histogram() # from a control change to its first sample playing
+
+
+    def as_dict(self):
+        return {
+            'uptime': time.time() - self.started,
+            'blocks': self.blocks,
+            'underruns': self.underruns,
+            'render_time': self.render_time.summary(),
+            'device_fill': self.device_fill.summary(),
+            'control_latency': self.control_latency.summary(),
+        }
+
+
+def format_stats(stats):
+    """Makes a one-line summary of PlaybackThread.get_stats()."""
+    line = ("render %.2f ms (p99 %.2f ms, %.0f%% CPU) - buffer %.1f ms - latency %.1f ms (p99 %.1f ms) - "
+            "%d underruns in %d blocks" % (
+                stats['render_time']['mean']*1000, stats['render_time']['p99']*1000, stats['load']*100,
+                stats['device_fill']['mean']*1000,
+                stats['control_latency']['mean']*1000, stats['control_latency']['p99']*1000,
+                stats['underruns'], stats['blocks']))
+
+    if stats.get('device_rate', stats['fs']) != stats['fs']:
+        line += " - resampled from %d to %d Hz" % (stats['fs'], stats['device_rate'])
+
+    scheduling = stats.get('scheduling')
+    if scheduling:
+        line += " - %s" % scheduling['policy']
+        if scheduling['policy'] in ('fifo', 'rr'):
+            line += " %d" % scheduling['priority']
+        if scheduling['cpus'] is not None:
+            line += " on CPUs %s" % ",".join(map(str, scheduling['cpus']))
+        if scheduling['memory_locked'] == 'all':
+            line += ", memory locked (recording buffer included)"
+        elif scheduling['memory_locked']:
+            line += ", memory locked"
+
+    effects = stats.get('effects')
+    if effects:
+        line += " - " + ", ".join(["%s %.2f ms" % (name, effects[name]['mean']*1000)
+                                   for name in EFFECTS if name in effects])
+    return line
+
+
+class Scheduling(object):
+    """How the audio thread asks to be run: a real-time policy, which CPUs and whether memory is locked.
+
+    Python 2 has no os.sched_* functions, so this goes to libc with ctypes.
+    Anything the system won't allow is left as it was with a warning, and
+    effective says what the thread really got.
+    """
+
+    def __init__(self, policy='other', priority=None, cpus=None, lock_memory=False):
+        if policy not in SCHED_POLICIES:
+            raise ValueError("unknown scheduling policy %r" % policy)
+        if cpus and not 0 <= min(cpus) <= max(cpus) < 1024:
+            raise ValueError("CPU numbers go from 0 to 1023")
+
+        self.policy = policy
+        self.priority = priority # defaults to the middle of the policy's range
+        self.cpus = cpus # a list of CPU numbers, None for any
+        self.lock_memory = lock_memory
+        self.effective = None # filled in by apply()
+
+
+    def warn(self, message):
+        sys.stderr.write("scheduling: %s\n" % message)
+
+
+    def apply(self):
+        """Applies the settings to the calling thread."""
+        import ctypes
+        import ctypes.util
+
+        libname = ctypes.util.find_library('c')
+        try:
+            libc = ctypes.CDLL(libname, use_errno=True)
+            libc.sched_setscheduler, libc.sched_setaffinity, libc.mlockall
+        except (OSError, AttributeError):
+            self.warn("not supported on this system")
+            self.effective = {'policy': 'unknown', 'priority': 0, 'cpus': None, 'memory_locked': False}
+            return self.effective
+
+        def error():
+            return os.strerror(ctypes.get_errno())
+
+        if self.policy != 'other':
+            policy = SCHED_POLICIES.index(self.policy)
+            low, high = libc.sched_get_priority_min(policy), libc.sched_get_priority_max(policy)
+            priority = self.priority
+            if priority is None:
+                priority = (low + high)/2
+            priority = min(max(priority, low), high)
+
+            param = ctypes.c_int(priority) # struct sched_param is just the priority
+            if libc.sched_setscheduler(0, policy, ctypes.byref(param)) != 0:
+                self.warn("couldn't switch to SCHED_%s: %s" % (self.policy.upper(), error()))
+
+        mask = ctypes.create_string_buffer(128) # a cpu_set_t
+        if self.cpus:
+            for cpu in self.cpus:
+                mask[cpu/8] = chr(ord(mask[cpu/8]) | 1 << cpu%8)
+            if libc.sched_setaffinity(0, len(mask), mask) != 0:
+                self.warn("couldn't pin to CPUs %s: %s" % (",".join(map(str, self.cpus)), error()))
+
+        # MCL_ONFAULT locks pages as they're first touched, so the pages
+        # the engine already uses are locked but the rest of the recording
+        # pool stays a reservation.  Kernels before 4.4 don't know it and
+        # would fault in and pin the whole pool.
+        memory_locked = False
+        if self.lock_memory:
+            if libc.mlockall(MCL_CURRENT | MCL_FUTURE | MCL_ONFAULT) == 0:
+                memory_locked = 'as used'
+            elif ctypes.get_errno() == errno.EINVAL and libc.mlockall(MCL_CURRENT | MCL_FUTURE) == 0:
+                memory_locked = 'all'
+                self.warn("locked all memory, recording buffer included")
+            else:
+                self.warn("couldn't lock memory: %s" % error())
+
+        # see what actually stuck
+        policy = libc.sched_getscheduler(0)
+        param = ctypes.c_int()
+        libc.sched_getparam(0, ctypes.byref(param))
+        cpus = None
+        if libc.sched_getaffinity(0, len(mask), mask) == 0:
+            cpus = [i for i in range(len(mask)*8) if ord(mask[i/8]) & 1 << i%8]
+
+        self.effective = {
+            'policy': policy < len(SCHED_POLICIES) and SCHED_POLICIES[policy] or str(policy),
+            'priority': param.value,
+            'cpus': cpus,
+            'memory_locked': memory_locked,
+        }
+        return self.effective
+
 
 class PlaybackThread(threading.Thread):
     """A thread that manages audio playback."""
 
-    def __init__(self, name, device):
+    def __init__(self, name, device, block_size=BLOCK_SIZE, oscillator='zero crossing',
+                 waveform='sine', interpolation='linear', backend='oss',
+                 record_frames=RECORDING_FRAMES, record_ring=False, stats_interval=0, params=None,
+                 scheduling=None, filters=(), effects=(), oversample=1, format=DEFAULT_FORMAT,
+                 engine_rate=None):
         super(PlaybackThread, self).__init__()
         self.name = name
 
-        self.fs = 44100 # the sample frequency
-        self.ft = INIT_FREQ # the base frequency of the instrument
-        self.vol = 1
+        self.sink = open_sink(backend, device, format)
+        self.format = self.sink.format # what the device actually took
 
-        if device != '/dev/null':
-            self.dsp = ossaudiodev.open(device, 'w')
-            self.dsp.setparameters(ossaudiodev.AFMT_S16_LE, 1, self.fs)
+        # the engine runs at the rate asked for, and if the device took
+        # another one it's resampled rather than played at the wrong pitch
+        self.fs = engine_rate or format.rate
+        self.resampler = None
+        if self.fs != self.format.rate:
+            self.resampler = Resampler(self.fs, self.format.rate)
+        self.engine = ToneEngine(self.fs, block_size, oscillator, waveform, interpolation, params, filters,
+                                 effects, oversample)
 
+        self._playing = threading.Event() # set while playing, so run() can sleep on it
         self.paused = True
         self.alive = True
-        self.recording = array.array('h') # *way* faster than a list for data access
+        self.record_frames = record_frames
+        self.record_ring = record_ring
+        self.recording = Recording(record_frames, record_ring, dtype=self.format.dtype,
+                                   channels=self.format.channels)
+        self.disk_recorder = None
+
+        self.stats = EngineStats()
+        self.stats_interval = stats_interval # seconds between log lines, 0 for none
+        self.scheduling = scheduling
 
         threading.Thread.__init__(self, name=name)
 
 
-    def run(self):
-        def tone_gen(fs):
-            """A tone sample generator."""
-            x = 0
-            pi = math.pi
-            sin = math.sin
-            ft = self.ft
-            sample = 0
-            prev_sample = 0
-            while 1:
-                prev_sample = sample
-                sample = sin(2*pi*ft*x/fs)
-
-                # The idea here is to keep the waveform continuous by only changing
-                # the frequency at the end of the previous frequency's period.  And
-                # it works!
-                if ft != self.ft and 0.01 > sample > -0.01 and prev_sample < sample:
-                    ft = self.ft
-                    x = 0
-
-                x += 1
-                yield sample*self.vol*0.95 # don't max out the range otherwise we clip
+    def _get_paused(self):
+        return not self._playing.isSet()
 
 
-        # to optimize loop performance, dereference everything ahead of time
-        tone = tone_gen(self.fs)
-        write_func = self.dsp.write
-        free_func = self.dsp.obuffree
-        pack_func = struct.pack
+    def _set_paused(self, paused):
+        if paused:
+            self._playing.clear()
+        else:
+            self._playing.set()
 
-        record_func = self.recording.append
+    paused = property(_get_paused, _set_paused)
 
-        while self.alive:
-            wave = ""
-            if not self.paused:
-                while not free_func():
-                    pass
 
-                clean = tone.next()
-                val_f = clean
-                val_i = int(val_f*(2**15 - 1))
+    def run(self):
+        if self.scheduling:
+            self.scheduling.apply()
+
+        # to optimize loop performance, dereference everything ahead of time
+        engine = self.engine
+        render = engine.render
+        wait_func = self.sink.wait
+        write_func = self.sink.write
+        encode = self.format.encode
+        resample = self.resampler and self.resampler.process
+        latency_func = self.sink.latency
+        block_size = engine.block_size
+        device_frames = int(math.ceil(block_size*float(self.format.rate)/self.fs)) # at most, per block
+        stats = self.stats
+        clock = time.time
+
+        starting = True # the device is expected to be empty when starting up
+        last_log = clock()
 
-                sample = pack_func("h", val_i)
-                write_func(sample)
-                record_func(val_i)
+        while self.alive:
+            if not self.paused:
+                # wake up now and then so pausing and stopping get noticed
+                if not wait_func(device_frames, 0.1):
+                    continue
+
+                start = clock()
+
+                # one write per block instead of one per sample
+                block = render()
+                if resample:
+                    block = resample(block)
+                samples = encode(block)
+                render_time = clock() - start
+
+                fill = latency_func()
+                write_func(samples.tostring())
+                self.recording.append(samples)
+
+                recorder = self.disk_recorder
+                if recorder is not None and recorder.alive:
+                    recorder.put(samples)
+
+                stats.blocks += 1
+                stats.render_time.add(render_time)
+                stats.device_fill.add(fill)
+                if fill <= 0 and not starting:
+                    stats.underruns += 1
+                if engine.fresh:
+                    stats.control_latency.add(engine.control_latency + fill)
+                starting = False
+
+                if self.stats_interval and start - last_log >= self.stats_interval:
+                    last_log = start
+                    sys.stderr.write("%s: %s\n" % (self.name, format_stats(self.get_stats())))
             else:
-                time.sleep(0.1)
+                starting = True
+                self._playing.wait()
+
+        self.sink.close()
 
 
     def stop(self):
+        self.stop_disk_recording()
+        self.recording.close()
         self.alive = False
+        self._playing.set() # wake up run() so it can exit
+
 
+    def start_disk_recording(self, filename):
+        """Starts streaming everything played to a WAV file."""
+        self.stop_disk_recording()
 
-    def set_new_freq(self, freq, vol):
+        recorder = DiskRecorder(filename, self.format, float(self.engine.block_size)/self.fs)
+        recorder.start()
+        self.disk_recorder = recorder
+        return recorder
+
+
+    def stop_disk_recording(self):
+        recorder = self.disk_recorder
+        if recorder is not None:
+            self.disk_recorder = None
+            recorder.stop()
+
+
+    def disk_recording_error(self):
+        """Returns why disk recording gave up, as a string, or None if it's going (or not on)."""
+        recorder = self.disk_recorder
+        if recorder is not None and recorder.error:
+            return str(recorder.error)
+        return None
+
+
+    def set_new_freq(self, freq, vol, voices=()):
         """Updates the input frequency."""
-        self.ft = freq
-        self.vol = vol
+        self.engine.set_new_freq(freq, vol, voices)
+
+
+    def set_waveform(self, waveform):
+        self.engine.set_waveform(waveform)
+
+
+    def set_oscillator(self, oscillator):
+        self.engine.set_oscillator(oscillator)
+
+
+    def set_filters(self, filters):
+        self.engine.set_filters(filters)
+
+
+    def set_effect(self, name, on):
+        self.engine.set_effect(name, on)
+
+
+    def get_stats(self):
+        """Returns counters and histograms describing how playback is keeping up."""
+        stats = self.stats.as_dict()
+        stats['block_size'] = self.engine.block_size
+        stats['fs'] = self.fs
+        stats['device_rate'] = self.format.rate
+        stats['format'] = self.format.format
+        stats['channels'] = self.format.channels
+        stats['latency'] = self.sink.latency()
+        stats['period_size'] = self.sink.period_size
+        stats['load'] = stats['render_time']['mean']*self.fs/self.engine.block_size
+        stats['scheduling'] = self.scheduling and self.scheduling.effective
+        stats['effects'] = self.engine.effects.summary()
+        return stats
 
 
     def get_wav_data(self):
@@ -140,52 +2124,423 @@ class PlaybackThread(threading.Thread):
 
 
     def clear_wav_data(self):
-        self.recording = []
+        # a fresh one rather than emptying it so a save in progress isn't upset
+        old = self.recording
+        self.recording = Recording(self.record_frames, self.record_ring, dtype=self.format.dtype,
+                                   channels=self.format.channels)
+        old.close()
 
 
+    def export(self, filename):
+        """Starts saving the recording to a WAV file, returns the ExportThread doing it."""
+        export = ExportThread(self.recording, filename, self.format)
+        export.start()
+        return export
 
 
-def iir_2pole(coeff1, coeff2):
-    """A two-pole IIR filter generator from that one guy's filter design page that I always use."""
+def _engine_process(conn, parent_conn, params, args, kwargs):
+    """The main loop of the process EngineProcess starts."""
+    # otherwise this end keeps the pipe open and the parent dying goes unnoticed
+    parent_conn.close()
 
-    xv = [0, 0, 0]
-    yv = [0, 0, 0]
-    
-    def iir(sample):
-        while 1:
-            xv[0] = xv[1]
-            xv[1] = xv[2]
-            xv[2] = sample
-            yv[0] = yv[1]
-            yv[1] = yv[2]
-            yv[2] = xv[0] + xv[2] - 2*xv[1] + coeff1*yv[0] + coeff2*yv[1]
-            yield yv[2]
-
-
-def discrete_tones(tones):
-    """Makes a discrete-tone filter that latches to particular tones."""
-       
-    def filt(x):
-        closest = tones[0]
-        err = 500000
-        mean = 0
-        
-        iir = iir_2pole(-.9979871157, 1.997850878)
-        
-        for i,tone in enumerate(tones):
-            tone_err = abs(x - tone)
-            if tone_err < err:
-                closest = tone
-                err = tone_err
-            elif tone_err > err:
-                if i > 0:
-                    mean = (x - closest)/2
-                    
-                break
-                
-        return closest + mean
+    try:
+        playback = PlaybackThread(params=params, *args, **kwargs)
+    except Exception, e:
+        conn.send(('error', "%s: %s" % (e.__class__.__name__, e)))
+        return
+
+    conn.send(('ok', (playback.fs, playback.format)))
+    playback.daemon = True # never outlive this process's main thread
+    playback.start()
+
+    export = None
+    while playback.alive:
+        try:
+            command, arg = conn.recv()
+        except (EOFError, IOError):
+            # the parent has gone, so there's no one left to stop the sound
+            playback.stop()
+            playback.join()
+            break
+
+        # a command that fails is passed back to be raised in the parent,
+        # rather than ending the loop and leaving it waiting for a reply
+        try:
+            result = None
+            if command == 'paused':
+                playback.paused = arg
+            elif command == 'stop':
+                playback.stop()
+                playback.join()
+            elif command == 'start_disk_recording':
+                playback.start_disk_recording(arg)
+            elif command == 'stop_disk_recording':
+                playback.stop_disk_recording()
+            elif command == 'disk_recording_error':
+                result = playback.disk_recording_error()
+            elif command == 'clear_wav_data':
+                playback.clear_wav_data()
+            elif command == 'waveform':
+                mipmap(arg, playback.engine.rate) # the parent publishes it once this is done
+            elif command == 'filters':
+                playback.set_filters(arg)
+            elif command == 'effect':
+                playback.set_effect(*arg)
+            elif command == 'stats':
+                result = playback.get_stats()
+            elif command == 'export':
+                export = playback.export(arg)
+            elif command == 'export_status':
+                if export is None:
+                    raise ValueError("nothing is being exported")
+                result = (export.isAlive(), export.progress, export.error and str(export.error))
+            elif command == 'export_cancel':
+                if export is not None:
+                    export.cancel()
+            else:
+                raise ValueError("unknown command %r" % command)
+            reply = ('ok', result)
+        except Exception, e:
+            reply = ('error', e)
+
+        conn.send(reply)
+
+
+class RemoteExport(object):
+    """Stands in for the ExportThread running in an EngineProcess."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.progress = 0.0
+        self.error = None
+
+
+    def isAlive(self):
+        alive, self.progress, self.error = self.engine.command('export_status')
+        return alive
+
+
+    def cancel(self):
+        self.engine.command('export_cancel')
+
+
+class EngineProcess(object):
+    """Runs a PlaybackThread in a separate process so the GUI can't hold up the audio.
+
+    It takes the same arguments and can be used in the same way.  Control
+    parameters go through a SharedParamMailbox and everything else is sent
+    down a pipe.
+    """
+
+    def __init__(self, name, device, block_size=BLOCK_SIZE, oscillator='zero crossing',
+                 waveform='sine', interpolation='linear', *args, **kwargs):
+        self.name = name
+        self.params = SharedParamMailbox(waveform=waveform, oscillator=oscillator)
+        self.lock = threading.Lock() # the pipe's request/response pairs mustn't get mixed up
+
+        self.conn, child_conn = multiprocessing.Pipe()
+        args = (name, device, block_size, oscillator, waveform, interpolation) + args
+        self.process = multiprocessing.Process(target=_engine_process, name=name,
+                                               args=(child_conn, self.conn, self.params, args, kwargs))
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+
+        status, result = self.conn.recv()
+        if status == 'error':
+            self.process.join()
+            raise IOError("the audio engine couldn't start: %s" % result)
+        self.fs, self.format = result
+
+        self._paused = True
+        self.disk_recorder = None # the file being recorded to, if any
+
+
+    def command(self, command, arg=None):
+        self.lock.acquire()
+        try:
+            self.conn.send((command, arg))
+            status, result = self.conn.recv()
+        finally:
+            self.lock.release()
+
+        if status == 'error':
+            raise result
+        return result
+
+
+    def start(self):
+        pass # the process is already running
+
+
+    def stop(self):
+        if self.process.is_alive():
+            self.command('stop')
+            self.process.join()
+
+
+    def _get_paused(self):
+        return self._paused
+
+
+    def _set_paused(self, paused):
+        self._paused = paused
+        self.command('paused', paused)
+
+    paused = property(_get_paused, _set_paused)
+
+
+    def set_new_freq(self, freq, vol, voices=()):
+        """Updates the input frequency."""
+        if len(voices) >= MAX_VOICES:
+            raise ValueError("at most %d voices can play at once" % MAX_VOICES)
+        self.params.publish(freq=freq, vol=vol, voices=tuple(voices))
+
+
+    def set_waveform(self, waveform):
+        # the child's main loop builds the tables first, so its audio thread
+        # doesn't have to, but this stays the mailbox's only writer
+        if waveform not in WAVEFORMS:
+            raise ValueError("unknown waveform %r" % waveform)
+        self.command('waveform', waveform)
+        self.params.publish(waveform=waveform)
+
+
+    def set_oscillator(self, oscillator):
+        self.params.publish(oscillator=oscillator)
+
+
+    def set_filters(self, filters):
+        self.command('filters', filters)
+
+
+    def set_effect(self, name, on):
+        self.command('effect', (name, on))
+
+
+    def start_disk_recording(self, filename):
+        self.command('start_disk_recording', filename)
+        self.disk_recorder = filename
+
+
+    def stop_disk_recording(self):
+        self.command('stop_disk_recording')
+        self.disk_recorder = None
+
+
+    def disk_recording_error(self):
+        return self.command('disk_recording_error')
+
+
+    def get_stats(self):
+        return self.command('stats')
+
+
+    def clear_wav_data(self):
+        self.command('clear_wav_data')
+
+
+    def export(self, filename):
+        self.command('export', filename)
+        return RemoteExport(self)
+
+
+
+
+class ToneIndex(object):
+    """Finds the nearest of a set of notes with a binary search.
+
+    Calling the index latches a frequency to the notes the way the discrete
+    mode always has, halfway towards the nearest note (or right onto it at
+    the top of the range).
+    """
+
+    def __init__(self, notes):
+        notes = sorted(notes, key=lambda note: note[1])
+        self.labels = [label for label,freq in notes]
+        self.freqs = [freq for label,freq in notes]
+
+        # the points halfway between neighbouring notes
+        self._bounds = [(lo + hi)/2.0 for lo,hi in zip(self.freqs, self.freqs[1:])]
+
+
+    def nearest(self, x):
+        """Returns the label and frequency of the note closest to x."""
+        i = bisect.bisect_left(self._bounds, x)
+        return self.labels[i], self.freqs[i]
+
+
+    def __call__(self, x):
+        i = bisect.bisect_left(self._bounds, x)
+        closest = self.freqs[i]
+        if i == len(self.freqs) - 1:
+            return closest
+        return closest + (x - closest)/2
+
+
+class NoteTable(object):
+    """The notes of a scale in one key, with what's needed to play and draw them.
+
+    Get these from note_table(), which keeps them around so switching scales
+    or keys is just a lookup.
+    """
+
+    def __init__(self, scale, key, tuning='equal'):
+        self.scale = scale
+        self.key = key
+        self.tuning = tuning
+
+        shift = KEY_SHIFTS[key]
+        intervals = SCALE_INTERVALS[scale]
+        steps = [(i - shift) % 12 for i in range(len(TUNINGS[tuning]))]
+
+        self.notes = [n for n,step in zip(TUNINGS[tuning], steps) if step in intervals]
+        self.labels = [label for label,freq in self.notes]
+        self.freqs = [freq for label,freq in self.notes]
+        self.roots = [step == 0 for step in steps if step in intervals]
+        self.index = ToneIndex(self.notes)
+
+        self._positions = {}
+
+
+    def positions(self, width, freq_min, freq_max):
+        """Returns the x coordinate of each note across a control area of the given width."""
+        key = (width, freq_min, freq_max)
+        if key not in self._positions:
+            if len(self._positions) > 8:
+                self._positions.clear() # don't keep every size the window's been through
+
+            scale = float(width)/(freq_max - freq_min)
+            self._positions[key] = [int((freq - freq_min)*scale) for freq in self.freqs]
+
+        return self._positions[key]
+
+
+    def harmonize(self, freq, parts):
+        """Returns the frequency of each of a voicing's parts (see VOICING_PARTS) to go with freq.
+
+        Scale degrees are counted from the nearest note and bent by as much
+        as freq is off it, so harmonies slide along with the lead.
+        """
+        freqs = self.freqs
+        i = bisect.bisect_left(freqs, freq)
+        if i == len(freqs) or (i > 0 and freq - freqs[i - 1] < freqs[i] - freq):
+            i -= 1
+        bend = freq/freqs[i]
+
+        harmony = []
+        for kind, n, gain in parts:
+            if kind == 'octave':
+                harmony.append(freq*2.0**n)
+            elif kind == 'degree':
+                harmony.append(freqs[min(max(i + n, 0), len(freqs) - 1)]*bend)
+            elif kind == 'drone':
+                harmony.append(TUNINGS[self.tuning][12*n + KEY_SHIFTS[self.key]][1])
+            else:
+                raise ValueError("unknown kind of voice %r" % kind)
+        return harmony
+
+
+    def voices(self, freq, vol, voicing):
+        """Shares vol out between the lead and a voicing's other voices so together they're as loud as one.
+
+        Returns the lead's volume and the (freq, vol) of each other voice,
+        ready for set_new_freq().
+        """
+        parts = VOICING_PARTS[voicing]
+        lead_vol = vol/(1 + sum([gain for kind, n, gain in parts]))
+        return lead_vol, zip(self.harmonize(freq, parts), [lead_vol*gain for kind, n, gain in parts])
+
+
+_note_tables = {}
 
-    return filt
+def note_table(scale, key, tuning='equal'):
+    """Returns the (cached) NoteTable for a scale and key."""
+    table = _note_tables.get((scale, key, tuning))
+    if table is None:
+        table = _note_tables[(scale, key, tuning)] = NoteTable(scale, key, tuning)
+    return table
+
+
+# gesture logs are this followed by GESTURE_RECORDs, all little-endian
+GESTURE_MAGIC = 'PTGEST01'
+GESTURE_RECORD = struct.Struct('<dffffBBBB') # 28 bytes, the voicing was padding in older logs
+MODES = ("continuous", "discrete")
+
+# x and y are fractions of the control area, from the left and the top
+Gesture = collections.namedtuple('Gesture', 'timestamp x y freq vol mode scale key voicing')
+
+class GestureLog(object):
+    """Logs every tone the GUI asks for to a binary file of fixed-size records.
+
+    Each record is the seconds since the log was opened, the pointer
+    position, the frequency and overall volume, and the mode, scale, key
+    and voicing they were played in.  gesture_tone() works out what that
+    sent to the synth.
+    """
+
+    def __init__(self, filename):
+        self.output = open(filename, 'wb')
+        self.output.write(GESTURE_MAGIC)
+        self.start = time.time()
+
+
+    def log(self, x, y, freq, vol, mode, scale, key, voicing='solo'):
+        self.output.write(GESTURE_RECORD.pack(time.time() - self.start, x, y, freq, vol,
+                                              MODES.index(mode), SCALES.index(scale), KEYS.index(key),
+                                              VOICINGS.index(voicing)))
+
+
+    def close(self):
+        self.output.close()
+
+
+def read_gestures(f):
+    """Reads the Gestures from a file written by GestureLog."""
+    if f.read(len(GESTURE_MAGIC)) != GESTURE_MAGIC:
+        raise ValueError("%s isn't a gesture log" % getattr(f, 'name', f))
+
+    size = GESTURE_RECORD.size
+    while 1:
+        data = f.read(size)
+        if len(data) < size:
+            break
+
+        t, x, y, freq, vol, mode, scale, key, voicing = GESTURE_RECORD.unpack(data)
+        yield Gesture(t, x, y, freq, vol, MODES[mode], SCALES[scale], KEYS[key], VOICINGS[voicing])
+
+
+def gesture_tone(gesture):
+    """Returns the (freq, vol, voices) a Gesture sent to set_new_freq()."""
+    vol, voices = note_table(gesture.scale, gesture.key).voices(gesture.freq, gesture.vol, gesture.voicing)
+    return gesture.freq, vol, voices
+
+
+class GestureReplay(threading.Thread):
+    """Plays gestures back into a PlaybackThread with their original timing."""
+
+    def __init__(self, gestures, playback):
+        threading.Thread.__init__(self, name="gesture replay")
+        self.gestures = gestures
+        self.playback = playback
+        self.alive = True
+
+
+    def stop(self):
+        self.alive = False
+
+
+    def run(self):
+        start = time.time()
+        for gesture in self.gestures:
+            delay = start + gesture.timestamp - time.time()
+            while delay > 0 and self.alive:
+                time.sleep(min(delay, 0.1))
+                delay = start + gesture.timestamp - time.time()
+
+            if not self.alive:
+                break
+            self.playback.set_new_freq(*gesture_tone(gesture))
 
 
 class ThereminApp(object):
@@ -198,37 +2553,45 @@ class ThereminApp(object):
         for thread in self.threads.values():
             thread.stop()
 
+        if self.gesture_log:
+            self.gesture_log.close()
+
         gtk.main_quit()
 
 
-    # the next 5 functions were ripped from the scribblesimple.py example
-    def configure_event(self, widget, event):
-        # Create a new backing pixmap of the appropriate size
-        x, y, width, height = widget.get_allocation()
-        self.pixmap = gtk.gdk.Pixmap(widget.window, width, height)
+    def drawing_tools(self, widget):
+        """Returns the GCs and text layout for drawing the fretboard, making them the first time."""
+        if self.tools is None:
+            colormap = gtk.gdk.colormap_get_system()
+
+            # this is the "intuitive" way to get the gc to be different colors... why isn't this in the pygtk tutorial???
+            gc = widget.window.new_gc()
+            gc.foreground = colormap.alloc_color(56360, 56360, 56360)
+
+            root_gc = widget.window.new_gc()
+            root_gc.foreground = colormap.alloc_color(20000, 60000, 20000)
+            root_gc.line_width = 3
+
+            layout = pango.Layout(widget.get_pango_context())
+            layout.set_font_description(pango.FontDescription("sans 8"))
 
-        self.pixmap.draw_rectangle(widget.get_style().black_gc,
-                              True, 0, 0, width, height)
+            self.tools = (gc, root_gc, layout)
 
-        notes = [(label, int(float(x - self.freq_min)*width/(self.freq_max - self.freq_min))) for label,x in self.discrete_notes]
-        root_notes = [(label, int(float(x - self.freq_min)*width/(self.freq_max - self.freq_min))) for label,x in self.root_notes]
+        return self.tools
 
-        ygrid = height/10
 
-        # this is the "intuitive" way to get the gc to be different colors... why isn't this in the pygtk tutorial???
-        gc = widget.window.new_gc()
-        gc.foreground = gtk.gdk.colormap_get_system().alloc_color(56360, 56360, 56360)
+    def draw_fretboard(self, widget, width, height):
+        """Draws the note lines and volume grid onto a new pixmap."""
+        pixmap = gtk.gdk.Pixmap(widget.window, width, height)
+        pixmap.draw_rectangle(widget.get_style().black_gc, True, 0, 0, width, height)
 
-        # TODO when things are cleaner we need to color the root notes differently
-        root_gc = widget.window.new_gc()
-        root_gc.foreground = gtk.gdk.colormap_get_system().alloc_color(20000, 60000, 20000)
-        root_gc.line_width = 3
+        gc, root_gc, layout = self.drawing_tools(widget)
+        positions = self.notes.positions(width, self.freq_min, self.freq_max)
 
-        pc = widget.get_pango_context()
-        layout = pango.Layout(pc)
-        layout.set_font_description(pango.FontDescription("sans 8"))
+        for label,x,root in zip(self.notes.labels, positions, self.notes.roots):
+            if x < 0 or x >= width:
+                continue
 
-        for label,x in notes:
             if len(label) == 3:
                 l = label[0] + label[2]
             else:
@@ -236,17 +2599,35 @@ class ThereminApp(object):
 
             layout.set_text(l)
 
-            if (label,x) in root_notes:
-                self.pixmap.draw_line(root_gc, x, 0, x, height)
-                self.pixmap.draw_layout(root_gc, x + 2, 0, layout)
+            if root:
+                pixmap.draw_line(root_gc, x, 0, x, height)
+                pixmap.draw_layout(root_gc, x + 2, 0, layout)
             else:
-                self.pixmap.draw_line(gc, x, 0, x, height)
-                self.pixmap.draw_layout(gc, x + 2, 0, layout)
+                pixmap.draw_line(gc, x, 0, x, height)
+                pixmap.draw_layout(gc, x + 2, 0, layout)
 
-        for y in range(height):
-            if y % ygrid == 0:
-                self.pixmap.draw_line(gc, 0, y, width, y)
+        ygrid = max(1, height/10)
+        for y in range(0, height, ygrid):
+            pixmap.draw_line(gc, 0, y, width, y)
 
+        return pixmap
+
+
+    # the next 5 functions were ripped from the scribblesimple.py example
+    def configure_event(self, widget, event):
+        # Use the backing pixmap for this scale and size, drawing it if it
+        # hasn't been already
+        x, y, width, height = widget.get_allocation()
+        key = (self.notes.scale, self.notes.key, self.notes.tuning,
+               self.freq_min, self.freq_max, width, height)
+
+        pixmap = self.fretboards.get(key)
+        if pixmap is None:
+            if len(self.fretboards) >= 8:
+                self.fretboards.clear() # mostly sizes left over from resizing
+            pixmap = self.fretboards[key] = self.draw_fretboard(widget, width, height)
+
+        self.pixmap = pixmap
         return True
 
 
@@ -260,13 +2641,15 @@ class ThereminApp(object):
 
 
     def redraw_input(self, widget):
-        # redraw the pixmap
+        # switch to the pixmap for the current scale
+        old = self.pixmap
         self.configure_event(widget, None)
 
-        # force the drawing area to be redrawn
-        alloc = widget.get_allocation()
-        rect = gtk.gdk.Rectangle(alloc.x, alloc.y, alloc.width, alloc.height)
-        widget.window.invalidate_rect(rect, True)
+        # force the drawing area to be redrawn, if anything changed
+        if self.pixmap is not old:
+            alloc = widget.get_allocation()
+            rect = gtk.gdk.Rectangle(0, 0, alloc.width, alloc.height)
+            widget.window.invalidate_rect(rect, True)
 
 
     def draw_brush(self, widget, x, y):
@@ -294,36 +2677,60 @@ class ThereminApp(object):
         if state & gtk.gdk.BUTTON1_MASK and self.pixmap != None:
             width, height = widget.window.get_size()
 
-            freq = (x/float(width))*(self.freq_max - self.freq_min) + self.freq_min
-            if freq > self.freq_max:
-                freq = self.freq_max
-            if freq < self.freq_min:
-                freq = self.freq_min
-
-            vol = (height - y)/float(height)
-            if vol > 1:
-                vol = 1
-            if vol < 0:
-                vol = 0
-            
-            vol = 9*vol + 1 # scale to the range 1 - 10
-            vol = math.log10(vol) # log scale
-
-            self.set_tone(freq, vol)
+            # just keep the latest position, it's handed on to the synth no
+            # more often than the control rate no matter how fast the mouse is
+            self.pointer = (x, y, width, height)
+            if not self.control_pending:
+                self.control_pending = True
+                delay = self.last_control + 1.0/self.control_rate - time.time()
+                if delay > 0:
+                    gobject.timeout_add(int(delay*1000) + 1, self.apply_pointer)
+                else:
+                    self.apply_pointer()
       
         return True
         #return widget.emit("motion_notify_event", event)
 
 
+    def apply_pointer(self):
+        """Sets the tone from the latest pointer position."""
+        self.control_pending = False
+        self.last_control = time.time()
+        x, y, width, height = self.pointer
+        self.position = (x/float(width), y/float(height))
+
+        freq = (x/float(width))*(self.freq_max - self.freq_min) + self.freq_min
+        if freq > self.freq_max:
+            freq = self.freq_max
+        if freq < self.freq_min:
+            freq = self.freq_min
+
+        vol = (height - y)/float(height)
+        if vol > 1:
+            vol = 1
+        if vol < 0:
+            vol = 0
+        
+        vol = 9*vol + 1 # scale to the range 1 - 10
+        vol = math.log10(vol) # log scale
+
+        self.set_tone(freq, vol)
+        return False
+
+
     def make_menu(self):
         menu_def = """
         <ui>
           <menubar name="MenuBar">
             <menu action="File">
               <menuitem action="SaveAs"/>
+              <menuitem action="LogGestures"/>
               <separator/>
               <menuitem action="Quit"/>
             </menu>
+            <menu action="View">
+              <menuitem action="Stats"/>
+            </menu>
             <menu action="Help">
               <menuitem action="About"/>
             </menu>
@@ -331,6 +2738,7 @@ class ThereminApp(object):
           <toolbar name="ToolBar">
             <toolitem action="Play"/>
             <toolitem action="Stop"/>
+            <toolitem action="Record"/>
           </toolbar>
         </ui>
         """
@@ -341,6 +2749,47 @@ class ThereminApp(object):
         def play(w):
             self.threads['playback'].paused = False
 
+        def log_gestures(w):
+            if not w.get_active():
+                if self.gesture_log:
+                    self.gesture_log.close()
+                    self.gesture_log = None
+                return
+
+            open_diag = gtk.FileChooserDialog(title="Log Gestures To", parent=self.window, action=gtk.FILE_CHOOSER_ACTION_SAVE,
+                                              buttons=(gtk.STOCK_CANCEL,gtk.RESPONSE_CANCEL,gtk.STOCK_SAVE,gtk.RESPONSE_OK))
+
+            if open_diag.run() == gtk.RESPONSE_OK:
+                self.gesture_log = GestureLog(open_diag.get_filename())
+            else:
+                w.set_active(False)
+
+            open_diag.destroy()
+
+        def record(w):
+            playback = self.threads['playback']
+            if not w.get_active():
+                playback.stop_disk_recording()
+                return
+
+            open_diag = gtk.FileChooserDialog(title="Record To File", parent=self.window, action=gtk.FILE_CHOOSER_ACTION_SAVE,
+                                              buttons=(gtk.STOCK_CANCEL,gtk.RESPONSE_CANCEL,gtk.STOCK_SAVE,gtk.RESPONSE_OK))
+            ffilt = gtk.FileFilter()
+            ffilt.add_pattern("*.wav")
+            open_diag.add_filter(ffilt)
+
+            if open_diag.run() == gtk.RESPONSE_OK:
+                try:
+                    playback.start_disk_recording(open_diag.get_filename())
+                    self.watch_disk_recording(w)
+                except (IOError, OSError, wave.Error), e:
+                    self.status.push(self.status.get_context_id("record"), "Couldn't record: %s" % e)
+                    w.set_active(False)
+            else:
+                w.set_active(False)
+
+            open_diag.destroy()
+
         # so this runs on older GTK versions (2.2?)
         try:
             self.about_dialog = gtk.AboutDialog()
@@ -353,17 +2802,20 @@ class ThereminApp(object):
             about_icon = gtk.STOCK_ABOUT
             play_icon = gtk.STOCK_MEDIA_PLAY
             stop_icon = gtk.STOCK_MEDIA_STOP
+            record_icon = gtk.STOCK_MEDIA_RECORD
         except AttributeError, e:
             self.about_dialog = None
             about_icon = None
             play_icon = None
             stop_icon = None
+            record_icon = None
 
 
         actions = [
         ('File', None, '_File'),
         ('SaveAs', gtk.STOCK_SAVE_AS, 'Save Recording _As...', None, 'Save recording', self.saveas),
         ('Quit', gtk.STOCK_QUIT, '_Quit', None, 'Quit', self.destroy),
+        ('View', None, '_View'),
         ('Help', None, '_Help'),
         ('About', about_icon, '_About', None, 'About', lambda w: self.about_dialog and self.about_dialog.show_all() and self.about_dialog.run()),
         
@@ -371,9 +2823,21 @@ class ThereminApp(object):
         ('Stop', stop_icon, 'Stop', None, 'Stop', stop),
         ]
 
+        toggle_actions = [
+        ('Record', record_icon, 'Record', None, 'Record to a file while playing', record,
+         self.threads['playback'].disk_recorder is not None),
+        ('LogGestures', None, '_Log Gestures...', None, 'Log every tone played to a file for replaying later',
+         log_gestures, self.gesture_log is not None),
+        ('Stats', None, 'Engine _Stats', None, 'Show how the audio engine is keeping up', self.toggle_stats, False),
+        ]
+
         ag = gtk.ActionGroup('menu')
         ag.add_actions(actions)
+        ag.add_toggle_actions(toggle_actions)
         
+        if self.threads['playback'].disk_recorder is not None:
+            self.watch_disk_recording(ag.get_action('Record')) # started with --record-to
+
         ui = gtk.UIManager()
         ui.insert_action_group(ag, 0)
         ui.add_ui_from_string(menu_def)
@@ -381,10 +2845,28 @@ class ThereminApp(object):
         return ui.get_widget('/MenuBar'), ui.get_widget('/ToolBar')
 
 
+    def watch_disk_recording(self, action):
+        """Turns the Record toggle back off if the recording stops itself, say when the disk fills up."""
+        def poll():
+            playback = self.threads['playback']
+            if playback.disk_recorder is None:
+                return False
+
+            error = playback.disk_recording_error()
+            if error:
+                self.status.push(self.status.get_context_id("record"), "Recording stopped: %s" % error)
+                action.set_active(False) # which stops it
+                return False
+            return True
+
+        gobject.timeout_add(500, poll)
+
+
     def make_input_widget(self, lower, upper):
         input_frame = gtk.Frame("Control")
         input = gtk.DrawingArea()
         input.set_size_request(100, 100)
+        self.inputs.append(input)
 
         input.show()
 
@@ -398,8 +2880,8 @@ class ThereminApp(object):
         input.set_events(gtk.gdk.EXPOSURE_MASK
                                 | gtk.gdk.LEAVE_NOTIFY_MASK
                                 | gtk.gdk.BUTTON_PRESS_MASK
-                                | gtk.gdk.POINTER_MOTION_MASK)
-                                #| gtk.gdk.POINTER_MOTION_HINT_MASK)
+                                | gtk.gdk.POINTER_MOTION_MASK
+                                | gtk.gdk.POINTER_MOTION_HINT_MASK)
 
 
         input_table = gtk.Table(4, 3, False)
@@ -489,13 +2971,65 @@ class ThereminApp(object):
         key_frame = gtk.Frame("Key")
         key_frame.set_shadow_type(gtk.SHADOW_NONE)
         key_ctl = gtk.combo_box_new_text()
-        for key in ["A", "A#", "B", "C", "C#", "D", "D#", "E", "F", "F#", "G", "G#"]:
+        for key in KEYS:
             key_ctl.append_text(key)
-        key_ctl.set_active(3)
+        key_ctl.set_active(list(KEYS).index(self.key))
         key_ctl.connect("changed", self.key_changed, key_ctl)
         key_frame.add(key_ctl)
         mode_and_key.pack_start(key_frame, False, False)
 
+        osc_and_wave = gtk.VBox(False, 1)
+
+        osc_frame = gtk.Frame("Oscillator")
+        osc_frame.set_shadow_type(gtk.SHADOW_NONE)
+        osc_ctls = gtk.VBox(False, 1)
+        osc_frame.add(osc_ctls)
+        osc_and_wave.pack_start(osc_frame, False, False)
+        opts_box.pack_start(osc_and_wave, False, False)
+
+        first_rb = None
+        for oscillator in OSCILLATORS:
+            rb = gtk.RadioButton(first_rb, oscillator)
+            if first_rb == None:
+                first_rb = rb
+            if oscillator == self.oscillator:
+                rb.set_active(True)
+
+            rb.connect("toggled", self.oscillator_changed, oscillator)
+            osc_ctls.pack_start(rb, False, False)
+
+        wave_frame = gtk.Frame("Waveform")
+        wave_frame.set_shadow_type(gtk.SHADOW_NONE)
+        wave_ctl = gtk.combo_box_new_text()
+        for waveform in WAVEFORMS:
+            wave_ctl.append_text(waveform)
+        wave_ctl.set_active(list(WAVEFORMS).index(self.waveform))
+        wave_ctl.connect("changed", self.waveform_changed)
+        wave_frame.add(wave_ctl)
+        osc_and_wave.pack_start(wave_frame, False, False)
+
+        voicing_frame = gtk.Frame("Voices")
+        voicing_frame.set_shadow_type(gtk.SHADOW_NONE)
+        voicing_ctl = gtk.combo_box_new_text()
+        for voicing in VOICINGS:
+            voicing_ctl.append_text(voicing)
+        voicing_ctl.set_active(list(VOICINGS).index(self.voicing))
+        voicing_ctl.connect("changed", self.voicing_changed)
+        voicing_frame.add(voicing_ctl)
+        osc_and_wave.pack_start(voicing_frame, False, False)
+
+        effects_frame = gtk.Frame("Effects")
+        effects_frame.set_shadow_type(gtk.SHADOW_NONE)
+        effects_ctls = gtk.VBox(False, 1)
+        effects_frame.add(effects_ctls)
+        opts_box.pack_start(effects_frame, False, False)
+
+        for name in EFFECTS:
+            cb = gtk.CheckButton(name)
+            cb.set_active(name in self.effects)
+            cb.connect("toggled", self.effect_toggled, name)
+            effects_ctls.pack_start(cb, False, False)
+
         volume_frame = gtk.Frame("Volume")
         volume_frame.set_shadow_type(gtk.SHADOW_NONE)
         volume = gtk.VScale(gtk.Adjustment(value=7, lower=1, upper=10))
@@ -510,9 +3044,8 @@ class ThereminApp(object):
 
         self.pixmap = None
 
-        self.inputs = []
-        self.inputs.append(self.make_input_widget(self.freq_min, self.freq_max))
-        self.root.pack_start(self.inputs[0], True, True)
+        self.inputs = [] # the drawing areas, make_input_widget() adds to this
+        self.root.pack_start(self.make_input_widget(self.freq_min, self.freq_max), True, True)
 
         self.window.show_all()
 
@@ -521,6 +3054,11 @@ class ThereminApp(object):
         self.status.show()
         self.root.pack_end(self.status, False, False)
 
+        self.stats_label = gtk.Label()
+        self.stats_label.set_alignment(0, 0.5)
+        self.stats_source = None # the timeout refreshing it while it's shown
+        self.root.pack_end(self.stats_label, False, False)
+
 
     def saveas(self, w):
         open_diag = gtk.FileChooserDialog(title="Save Recording", parent=self.window, action=gtk.FILE_CHOOSER_ACTION_SAVE,
@@ -532,10 +3070,7 @@ class ThereminApp(object):
         response = open_diag.run()
 
         if response == gtk.RESPONSE_OK:
-            output = wave.open(open_diag.get_filename(), 'w')
-            output.setnchannels(1)
-            output.setsampwidth(2)
-            output.setframerate(44100)
+            export = self.threads['playback'].export(open_diag.get_filename())
 
             pbar = gtk.ProgressBar()
             pbar.set_fraction(0)
@@ -547,59 +3082,46 @@ class ThereminApp(object):
             d.set_has_separator(True)
             d.show_all()
 
-            abort = [False]
-
-            def print_response(w, r):
-                if abort[0] == False:
-                    abort[0] = True
-
-            d.connect("response", print_response)
-
-            n = len(self.threads['playback'].get_wav_data())
-            for i,sample in enumerate(self.threads['playback'].get_wav_data()):
-                if i % 256 == 0:
-                    pbar.set_fraction(float(i)/n)
+            d.connect("response", lambda w, r: export.cancel())
 
-                    # so that the progress bar dialog shows/updates
-                    while gtk.events_pending():
-                        gtk.mainiteration()
+            # the export runs in its own thread, this just keeps the dialog
+            # up to date until it's done
+            def poll():
+                alive = export.isAlive()
+                pbar.set_fraction(export.progress)
+                if alive:
+                    return True
 
-                    if abort[0]:
-                        break
-
-                output.writeframes(struct.pack('h', sample))
-
-            output.close()
+                d.destroy()
+                if export.error:
+                    self.status.push(self.status.get_context_id("export"),
+                                     "Couldn't save recording: %s" % export.error)
+                return False
 
-            d.destroy()
+            gobject.timeout_add(100, poll)
 
         open_diag.destroy()
 
 
 
     def new_tone_filter(self):
-        self.root_notes = [n for i,n in enumerate(self.shifted_notes) if i % 12 == 0]
+        self.notes = note_table(self.scale, self.key)
+        self.tone_filter = self.notes.index
+        if self.freq > 0:
+            self.set_tone(self.freq, self.vol) # the harmony may have changed
 
-        if self.scale == 'chromatic':
-            key_notes = NOTES
+        # redraw once the handler's returned, and only once if several
+        # options change together
+        if not self.redraw_pending:
+            self.redraw_pending = True
+            gobject.idle_add(self.redraw_inputs)
 
-        elif self.scale == 'diatonic major':
-            key_notes = [n for i,n in enumerate(self.shifted_notes) if i % 12 in diatonic_major_intervals]
-
-        elif self.scale == 'pentatonic major':
-            key_notes = [n for i,n in enumerate(self.shifted_notes) if i % 12 in pentatonic_major_intervals]
-
-        elif self.scale == 'pentatonic minor':
-            key_notes = [n for i,n in enumerate(self.shifted_notes) if i % 12 in pentatonic_minor_intervals]
-
-        elif self.scale == 'blues':
-            key_notes = [n for i,n in enumerate(self.shifted_notes) if i % 12 in blues_intervals]
-
-        self.tone_filter = discrete_tones(just_freqs(key_notes))
-        self.discrete_notes = key_notes
 
+    def redraw_inputs(self):
+        self.redraw_pending = False
         for input in self.inputs:
             self.redraw_input(input)
+        return False
 
 
     def scale_changed(self, button, scale_name):
@@ -614,28 +3136,33 @@ class ThereminApp(object):
             self.new_tone_filter()
 
 
-    def key_changed(self, button, key):
-        self.key = key.get_active_text()
+    def oscillator_changed(self, button, oscillator):
+        if button.get_active():
+            self.oscillator = oscillator
+            self.threads['playback'].set_oscillator(oscillator)
 
-        self.shifted_notes = list(NOTES)
-        shifts = {
-            'A': 9,
-            'A#': 10,
-            'B': 11,
-            'C': 0,
-            'C#': 1,
-            'D': 2,
-            'D#': 3,
-            'E': 4,
-            'F': 5,
-            'F#': 6,
-            'G': 7,
-            'G#': 8,
-        }
 
-        for i in range(shifts[self.key]):
-            self.shifted_notes.append(self.shifted_notes.pop(0))
+    def waveform_changed(self, combo):
+        self.waveform = combo.get_active_text()
+        self.threads['playback'].set_waveform(self.waveform)
+
+
+    def effect_toggled(self, button, name):
+        on = button.get_active()
+        if on:
+            self.effects.add(name)
+        else:
+            self.effects.discard(name)
+        self.threads['playback'].set_effect(name, on)
+
+
+    def voicing_changed(self, combo):
+        self.voicing = combo.get_active_text()
+        self.set_tone(self.freq, self.vol)
 
+
+    def key_changed(self, button, key):
+        self.key = key.get_active_text()
         self.new_tone_filter()
 
 
@@ -653,9 +3180,53 @@ class ThereminApp(object):
         else:
             closest = freq
 
-        self.status.push(self.status.get_context_id("note"), "Output frequency:  %.2f Hz - volume %.2f%%" % (closest, vol))
+        self.show_status("Output frequency:  %.2f Hz - volume %.2f%%" % (closest, vol))
+
+        lead_vol, voices = self.notes.voices(closest, vol*self.master_volume, self.voicing)
+        self.threads['playback'].set_new_freq(closest, lead_vol, voices)
+
+        if self.gesture_log:
+            x, y = self.position
+            self.gesture_log.log(x, y, closest, vol*self.master_volume, self.mode, self.scale, self.key,
+                                 self.voicing)
+
+
+    def show_status(self, text):
+        """Shows a message in the statusbar, updating it no more than STATUS_RATE times a second."""
+        self.status_text = text
+        if not self.status_pending:
+            self.status_pending = True
+            gobject.timeout_add(1000/STATUS_RATE, self.update_status)
+
+
+    def update_status(self):
+        self.status_pending = False
+        context = self.status.get_context_id("note")
+        self.status.pop(context) # or the statusbar's stack grows forever
+        self.status.push(context, self.status_text)
+        return False
+
+
+    def toggle_stats(self, action):
+        if action.get_active():
+            self.stats_label.show()
+            self.update_stats()
+            if self.stats_source is None:
+                self.stats_source = gobject.timeout_add(1000, self.update_stats)
+        else:
+            self.stats_label.hide()
+            if self.stats_source is not None:
+                gobject.source_remove(self.stats_source)
+                self.stats_source = None
+
+
+    def update_stats(self):
+        if not self.stats_label.get_property('visible'):
+            self.stats_source = None
+            return False
 
-        self.threads['playback'].set_new_freq(closest, vol*self.master_volume)
+        self.stats_label.set_text(format_stats(self.threads['playback'].get_stats()))
+        return True
 
 
     def pause(self, button):
@@ -665,27 +3236,62 @@ class ThereminApp(object):
             self.threads['playback'].paused = True
     
     
-    def __init__(self, device):
+    def __init__(self, device, block_size=BLOCK_SIZE, oscillator='zero crossing',
+                 waveform='sine', interpolation='linear', backend='oss',
+                 record_frames=RECORDING_FRAMES, record_ring=False, record_to=None,
+                 control_rate=CONTROL_RATE, stats_interval=0, gesture_log=None, engine='thread',
+                 scheduling=None, filters=(), effects=(), oversample=1, freq_max=FREQ_MAX,
+                 format=DEFAULT_FORMAT, engine_rate=None):
 
         self.threads = {}
 
-        self.threads['playback'] = PlaybackThread("playback", device)
+        if engine == 'process':
+            playback_class = EngineProcess
+        elif engine == 'thread':
+            playback_class = PlaybackThread
+        else:
+            raise ValueError("unknown engine %r" % engine)
+
+        self.threads['playback'] = playback_class("playback", device, block_size, oscillator,
+                                                  waveform, interpolation, backend,
+                                                  record_frames, record_ring, stats_interval,
+                                                  scheduling=scheduling, filters=filters, effects=effects,
+                                                  oversample=oversample, format=format,
+                                                  engine_rate=engine_rate)
+        self.oscillator = oscillator
+        self.waveform = waveform
+        self.effects = set(effects)
+        if record_to:
+            self.threads['playback'].start_disk_recording(record_to)
 
         self.freq = INIT_FREQ
         self.freq = 0
-        self.freq_max = 2000
+        playback = self.threads['playback']
+        self.freq_max = min(freq_max, playback.fs/2.0, playback.format.rate/2.0) # the resampler cuts the rest
         self.freq_min = 20
 
         self.mode = 'continuous'
         self.scale = 'chromatic'
         self.key = 'C'
-        self.shifted_notes = NOTES
-        self.discrete_notes = NOTES
-        self.root_notes = [x for i,x in enumerate(NOTES) if i % 12 == 0]
+        self.voicing = 'solo'
+        self.notes = note_table(self.scale, self.key)
         self.master_volume = math.log10(7.2)
         self.vol = 0
 
-        self.tone_filter = discrete_tones(just_freqs(NOTES))
+        self.tone_filter = self.notes.index
+        self.redraw_pending = False
+        self.tools = None
+        self.fretboards = {} # prerendered backing pixmaps
+
+        self.control_rate = control_rate
+        self.control_pending = False
+        self.last_control = 0
+        self.pointer = None
+        self.status_text = ""
+        self.status_pending = False
+
+        self.position = (-1, -1) # of the pointer as a fraction of the control area
+        self.gesture_log = gesture_log and GestureLog(gesture_log)
 
         self.init_ui()
         gtk.gdk.threads_init()
@@ -1123,31 +3729,382 @@ class ThereminApp(object):
       "\0\377\377\377\0\377\377\377\0"
 
 
+def read_controls(f):
+    """Reads a text control stream, one "seconds frequency volume" event per line.
+
+    Volumes go from 0 to 1.  Blank lines and lines starting with # are skipped.
+    """
+    for line in f:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+
+        t, freq, vol = line.split()[:3]
+        yield float(t), float(freq), float(vol)
+
+
+def read_control_file(filename):
+    """Reads (seconds, frequency, volume) events from a gesture log or a text control stream.
+
+    A gesture log's events also have the voices played along with the lead.
+    """
+    f = open(filename, 'rb')
+    if f.read(len(GESTURE_MAGIC)) == GESTURE_MAGIC:
+        f.seek(0)
+        return ((g.timestamp,) + gesture_tone(g) for g in read_gestures(f))
+
+    f.seek(0)
+    return read_controls(f)
+
+
+def replay_gestures(filename, device, backend='oss', block_size=BLOCK_SIZE, oscillator='zero crossing',
+                    waveform='sine', interpolation='linear', tail=0.5, scheduling=None, filters=(), effects=(),
+                    oversample=1, format=DEFAULT_FORMAT, engine_rate=None):
+    """Plays a gesture log through the audio engine in real time, returns the engine's stats."""
+    playback = PlaybackThread("replay", device, block_size, oscillator, waveform, interpolation, backend,
+                              scheduling=scheduling, filters=filters, effects=effects, oversample=oversample,
+                              format=format, engine_rate=engine_rate)
+    playback.set_new_freq(INIT_FREQ, 0)
+    playback.start()
+
+    replay = GestureReplay(read_gestures(open(filename, 'rb')), playback)
+    playback.paused = False
+    try:
+        replay.run()
+        time.sleep(tail)
+    finally:
+        playback.stop()
+        playback.join()
+
+    return playback.get_stats()
+
+
+def render_controls(events, filename, format=DEFAULT_FORMAT, block_size=BLOCK_SIZE, oscillator='zero crossing',
+                    waveform='sine', interpolation='linear', scale=None, key='C', tail=0.5, filters=(),
+                    effects=(), oversample=1, engine_rate=None):
+    """Renders (seconds, frequency, volume) events to a WAV file as fast as the CPU allows.
+
+    An event can also have a list of (freq, vol) voices to play along with
+    the lead, as read_control_file() gives for a gesture log.  If a scale
+    is given the frequencies are latched to its notes the way the discrete
+    mode does.  With an engine_rate the synthesis runs at that rate and is
+    resampled to the file's.  Returns the number of frames written.
+    """
+    fs = engine_rate or format.rate
+    engine = ToneEngine(fs, block_size, oscillator, waveform, interpolation, filters=filters, effects=effects,
+                        oversample=oversample)
+    engine.set_new_freq(INIT_FREQ, 0) # silent until the first event
+    if scale and scale not in SCALES:
+        raise ValueError("unknown scale %r" % scale)
+    if key not in KEYS:
+        raise ValueError("unknown key %r" % key)
+    index = scale and note_table(scale, key).index
+    resample = fs != format.rate and Resampler(fs, format.rate).process
+
+    sink = WaveFileSink(filename, format, realtime=False)
+    rendered = 0 # at the engine's rate
+    frames = 0 # at the file's
+
+    def write():
+        block = engine.render()
+        if resample:
+            block = resample(block)
+        sink.write(format.encode(block).tostring())
+        return len(block)
+
+    try:
+        for event in events:
+            t, freq, vol = event[:3]
+            voices = len(event) > 3 and event[3] or ()
+
+            # events land on the block boundary just like they do live
+            while rendered + block_size <= t*fs:
+                frames += write()
+                rendered += block_size
+
+            if index:
+                freq = index(freq)
+            engine.set_new_freq(freq, vol, voices)
+
+        for i in range(int(math.ceil(tail*fs/block_size))):
+            frames += write()
+    finally:
+        sink.close()
+
+    return frames
+
+
 def usage(pname):
     print """Usage:  %s [OPTIONS]
 
 Options:
 
-    --device=DEV    The device filename to open.  Defauts to /dev/dsp.
+    --rate=HZ       The sample rate to ask the device for.  Lower rates
+                    take less CPU.  Defaults to 44100.  If the device
+                    takes another rate the sound is resampled to it.
+    --engine-rate=HZ
+                    Synthesize at this rate and resample to the device's,
+                    or with --render the file's.  Defaults to --rate.
+    --format=FORMAT The sample format, one of %s.
+                    Defaults to s16.
+    --channels=N    How many channels to play the same sound in.
+                    Defaults to 1.
+    --backend=NAME  How to output audio, one of:
+                      oss   an OSS device (the default)
+                      alsa  an ALSA device, "default" goes through
+                            PulseAudio where it's running
+                      wav   a WAV file
+                      raw   a file of bare little-endian samples
+                      null  nowhere, but at the speed of a sound card
+    --device=DEV    The device or filename to open.  Defauts to /dev/dsp
+                    for OSS and "default" for ALSA.
+    --engine=WHERE  Run the audio engine in a "thread" (the default) or a
+                    separate "process", which keeps the audio going while
+                    the window is busy.
+    --sched=POLICY  Ask for real-time scheduling for the audio thread, fifo
+                    or rr.  Needs root or an rtprio limit; without one it
+                    carries on as it was, with a warning.
+    --priority=N    The real-time priority to ask for.  Defaults to the
+                    middle of the range.
+    --cpus=LIST     Pin the audio thread to some CPUs, e.g. 2 or 2,3.
+    --lock-memory   Lock the engine's memory into RAM so it never waits
+                    for a page to be swapped in.  The recording buffer is
+                    locked only as it fills, except on kernels before 4.4
+                    where all of it is locked up front.
+    --block-size=N  Frames rendered per write to the device.  Smaller
+                    blocks lower the latency but cost more CPU.  Defaults
+                    to %d.
+    --control-rate=HZ
+                    How many times a second mouse movement is passed on to
+                    the synthesizer.  Defaults to %d.
+    --stats-interval=SECS
+                    Print a line of audio engine statistics every so often.
+    --record-to=FILE
+                    Start out streaming everything played to a WAV file.
+    --record-memory=MINUTES
+                    How much of the recording to keep in memory, past that
+                    it's moved to a temporary file.  Defaults to %d.
+    --record-last=MINUTES
+                    Only keep the last few minutes of the recording.
+    --oscillator=OSC
+                    Either "zero-crossing", which changes pitch at the end
+                    of the current period, or "phase", which glides to the
+                    new pitch and volume within one block.  Defaults to
+                    zero-crossing.
+    --waveform=WAVE One of %s.  Defaults to sine.
+    --interpolation=INTERP
+                    How the waveform tables are read, either linear or
+                    cubic.  Defaults to linear.
+    --oversample=N  Run the oscillators 2 or 4 times faster than the
+                    output and filter back down, for brighter high notes
+                    at some CPU cost.  Defaults to 1, no oversampling.
+    --freq-max=HZ   The highest frequency of the control area, up to half
+                    the sample rate.  Defaults to %d.
+    --filter=FILTER Run the output through a filter, one of
+                      lowpass:FREQ[:Q], highpass:FREQ[:Q],
+                      bandpass:FREQ[:Q] or formant:VOWEL (a, e, i, o
+                      or u).  Give it more than once to chain filters,
+                      e.g. --filter=formant:o --filter=lowpass:3000.
+    --effects=LIST  Start with some of %s on,
+                    separated by commas.  They can be switched on and off
+                    in the window.
+    --log-gestures=FILE
+                    Start out logging every tone played to FILE.
+    --replay=FILE   Don't open a window, instead play a gesture log back
+                    in real time through the backend and print the audio
+                    engine's statistics at the end.
+    --render=FILE   Don't open a window, instead render a gesture log or
+                    a control stream (one "seconds frequency volume" line
+                    per event) to the WAV file given with --output as fast
+                    as possible.  The synth options above apply.
+    --output=FILE   Where --render writes to.
+    --scale=SCALE   With --render, latch the frequencies to the notes of
+                    a scale, one of %s.
+    --key=KEY       The key for --scale.  Defaults to C.
     --help          Display this help text and exit.
-    """ % pname
+    """ % (pname, ", ".join(SAMPLE_FORMATS), BLOCK_SIZE, CONTROL_RATE, RECORDING_FRAMES/(60*44100), ", ".join(WAVEFORMS),
+           FREQ_MAX, ", ".join(EFFECTS), ", ".join(SCALES))
+
+
+def usage_error(pname, message):
+    sys.stderr.write("%s: %s\n" % (pname, message))
+    usage(pname)
+    sys.exit(1)
 
 
 def main():
     import getopt
-    import sys
 
-    opts, args = getopt.getopt(sys.argv[1:], '', ['device=', 'help'])
-
-    dev = '/dev/dsp'
+    opts, args = getopt.getopt(sys.argv[1:], '', ['rate=', 'engine-rate=', 'format=', 'channels=', 'backend=', 'device=', 'engine=', 'sched=', 'priority=',
+                                                  'cpus=', 'lock-memory', 'block-size=', 'oscillator=',
+                                                  'control-rate=', 'stats-interval=', 'record-to=',
+                                                  'record-memory=', 'record-last=', 'waveform=',
+                                                  'interpolation=', 'oversample=', 'freq-max=', 'filter=', 'effects=', 'log-gestures=', 'replay=', 'render=',
+                                                  'output=', 'scale=', 'key=', 'help'])
+
+    rate = DEFAULT_FORMAT.rate
+    engine_rate = None
+    sample_format = DEFAULT_FORMAT.format
+    channels = DEFAULT_FORMAT.channels
+    backend = 'oss'
+    dev = None
+    engine = 'thread'
+    sched_policy = 'other'
+    sched_priority = None
+    cpus = None
+    lock_memory = False
+    block_size = BLOCK_SIZE
+    record_minutes = float(RECORDING_FRAMES)/(60*DEFAULT_FORMAT.rate)
+    record_ring = False
+    record_to = None
+    control_rate = CONTROL_RATE
+    stats_interval = 0
+    oscillator = 'zero crossing'
+    waveform = 'sine'
+    interpolation = 'linear'
+    oversample = 1
+    freq_max = FREQ_MAX
+    filters = []
+    effects = []
+    gesture_log = None
+    replay_from = None
+    render_from = None
+    output = None
+    scale = None
+    key = 'C'
     for opt,val in opts:
-        if opt == '--device':
+        if opt == '--rate':
+            rate = int(val)
+        elif opt == '--engine-rate':
+            engine_rate = int(val)
+        elif opt == '--format':
+            sample_format = val
+        elif opt == '--channels':
+            channels = int(val)
+        elif opt == '--backend':
+            backend = val
+        elif opt == '--device':
             dev = val
+        elif opt == '--engine':
+            engine = val
+        elif opt == '--sched':
+            sched_policy = val
+        elif opt == '--priority':
+            sched_priority = int(val)
+        elif opt == '--cpus':
+            cpus = [int(cpu) for cpu in val.split(',')]
+        elif opt == '--lock-memory':
+            lock_memory = True
+        elif opt == '--block-size':
+            block_size = int(val)
+        elif opt == '--control-rate':
+            control_rate = float(val)
+        elif opt == '--stats-interval':
+            stats_interval = float(val)
+        elif opt == '--record-to':
+            record_to = val
+        elif opt == '--record-memory':
+            record_minutes = float(val)
+        elif opt == '--record-last':
+            record_minutes = float(val)
+            record_ring = True
+        elif opt == '--oscillator':
+            oscillator = val.replace('-', ' ')
+        elif opt == '--waveform':
+            waveform = val
+        elif opt == '--interpolation':
+            interpolation = val
+        elif opt == '--oversample':
+            oversample = int(val)
+        elif opt == '--freq-max':
+            freq_max = float(val)
+        elif opt == '--filter':
+            try:
+                filters.append(parse_filter(val))
+            except ValueError, e:
+                usage_error(sys.argv[0], e)
+        elif opt == '--effects':
+            effects = val.split(',')
+        elif opt == '--log-gestures':
+            gesture_log = val
+        elif opt == '--replay':
+            replay_from = val
+        elif opt == '--render':
+            render_from = val
+        elif opt == '--output':
+            output = val
+        elif opt == '--scale':
+            scale = val
+        elif opt == '--key':
+            key = val
         elif opt == '--help':
             usage(sys.argv[0])
             sys.exit(0)
 
-    app = ThereminApp(device=dev)
+    named = [('backend', backend, BACKENDS), ('engine', engine, ENGINES),
+             ('oscillator', oscillator, OSCILLATORS), ('waveform', waveform, WAVEFORMS),
+             ('interpolation', interpolation, INTERPOLATIONS), ('oversampling factor', oversample, OVERSAMPLING)]
+    named += [('effect', effect, EFFECTS) for effect in effects]
+    named += [('key', key, KEYS)] + (scale is not None and [('scale', scale, SCALES)] or [])
+    for name, value, choices in named:
+        if value not in choices:
+            usage_error(sys.argv[0], "unknown %s %r" % (name, value))
+
+    try:
+        format = AudioFormat(rate, sample_format, channels)
+    except ValueError, e:
+        usage_error(sys.argv[0], e)
+    record_frames = int(record_minutes*60*rate)
+
+    if filters:
+        try:
+            filter_system(filters, engine_rate or rate)
+        except ValueError, e:
+            usage_error(sys.argv[0], e)
+
+    scheduling = None
+    if sched_policy != 'other' or sched_priority is not None or cpus or lock_memory:
+        scheduling = Scheduling(sched_policy, sched_priority, cpus, lock_memory)
+
+    if render_from:
+        if not output:
+            usage(sys.argv[0])
+            sys.exit(1)
+
+        start = time.time()
+        frames = render_controls(read_control_file(render_from), output, format, block_size,
+                                 oscillator, waveform, interpolation, scale, key, filters=filters,
+                                 effects=effects, oversample=oversample, engine_rate=engine_rate)
+        sys.stderr.write("rendered %.1f seconds in %.1f seconds\n" % (frames/float(rate), time.time() - start))
+        return
+
+    if dev is None:
+        if backend == 'alsa':
+            dev = 'default'
+        elif backend in ('wav', 'raw'):
+            usage(sys.argv[0])
+            sys.exit(1)
+        else:
+            dev = '/dev/dsp'
+
+    if replay_from:
+        stats = replay_gestures(replay_from, dev, backend, block_size, oscillator, waveform, interpolation,
+                                scheduling=scheduling, filters=filters, effects=effects,
+                                oversample=oversample, format=format, engine_rate=engine_rate)
+        sys.stderr.write("%s\n" % format_stats(stats))
+        return
+
+    if gtk is None:
+        sys.stderr.write("%s needs PyGTK 2.4+ to run\n" % NAME)
+        sys.exit(1)
+
+    app = ThereminApp(device=dev, backend=backend, block_size=block_size, oscillator=oscillator,
+                      waveform=waveform, interpolation=interpolation,
+                      record_frames=record_frames, record_ring=record_ring, record_to=record_to,
+                      control_rate=control_rate, stats_interval=stats_interval,
+                      gesture_log=gesture_log, engine=engine, scheduling=scheduling,
+                      filters=filters, effects=effects, oversample=oversample, freq_max=freq_max,
+                      format=format, engine_rate=engine_rate)
     app.main()
 
 